@@ -0,0 +1,211 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+
+def _to_bool(v):
+    # simplenote sends 0 / 1, older notes on disc might have "0" / "1"
+    return bool(int(v))
+
+
+def _to_tuple(v):
+    return tuple(v)
+
+
+def _to_unicode(v):
+    if isinstance(v, str):
+        return unicode(v, 'utf-8')
+
+    return v
+
+
+class Note(object):
+    """A single note in NotesDB.notes.
+
+    Simplenote and the stores deal in dictionaries with loosely typed values,
+    dates for example can arrive as strings. A Note converts them once, when
+    it is created from such a dictionary or when a field is set, so that the
+    rest of nvPY can compare n.modifydate and n.syncdate directly. Unknown
+    fields are kept in extra and survive the round trip.
+
+    Dates are floats, syncnum and version ints, tags and systemtags tuples
+    and deleted a bool. A field that the note does not have is None.
+
+    A case insensitive search keeps the lowercased content it made with
+    set_folded(), until the content is replaced.
+
+    For existing callers, a Note also behaves like the dictionary it was
+    made from: n['content'], n.get('tags'), 'key' in n and n.update(d) all
+    work, with the converted values. to_dict() gives back a dictionary in
+    the Simplenote format, for the stores and the server.
+    """
+
+    # field name: conversion of incoming values
+    FIELDS = {
+        'key': None,
+        'content': _to_unicode,
+        'createdate': float,
+        'modifydate': float,
+        'syncdate': float,
+        'savedate': float,
+        'syncnum': int,
+        'version': int,
+        'minversion': int,
+        'tags': _to_tuple,
+        'systemtags': _to_tuple,
+        'deleted': _to_bool,
+    }
+
+    # content is a property around _content, see set_folded()
+    __slots__ = tuple(f for f in FIELDS if f != 'content') + \
+        ('_content', '_folded', 'extra')
+
+    def __init__(self, d=None):
+        for f in self.FIELDS:
+            setattr(self, f, None)
+
+        self.extra = None
+        if d:
+            self.update(d)
+
+    def _get_content(self):
+        return self._content
+
+    def _set_content(self, c):
+        self._content = c
+        self._folded = None
+
+    content = property(_get_content, _set_content)
+
+    def get_folded(self):
+        """Return the content in lowercase, None if it is not known.
+        """
+
+        return self._folded
+
+    def set_folded(self, content, folded):
+        """Keep folded as the lowercased content, if content is still the
+        content of the note.
+        """
+
+        if content is self._content:
+            self._folded = folded
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d)
+
+    def to_dict(self):
+        d = {}
+        for f in self.FIELDS:
+            v = getattr(self, f)
+            if v is not None:
+                if f in ('tags', 'systemtags'):
+                    v = list(v)
+
+                elif f == 'deleted':
+                    v = int(v)
+
+                d[f] = v
+
+        if self.extra:
+            d.update(self.extra)
+
+        return d
+
+    @property
+    def pinned(self):
+        return bool(self.systemtags) and 'pinned' in self.systemtags
+
+    @property
+    def markdown(self):
+        return bool(self.systemtags) and 'markdown' in self.systemtags
+
+    # the dictionary interface
+
+    def __getitem__(self, f):
+        if f in self.FIELDS:
+            v = getattr(self, f)
+            if v is None:
+                raise KeyError(f)
+
+            return v
+
+        if self.extra is None:
+            raise KeyError(f)
+
+        return self.extra[f]
+
+    def get(self, f, default=None):
+        try:
+            return self[f]
+
+        except KeyError:
+            return default
+
+    def __setitem__(self, f, v):
+        if f in self.FIELDS:
+            conv = self.FIELDS[f]
+            setattr(self, f, v if v is None or conv is None else conv(v))
+
+        else:
+            if self.extra is None:
+                self.extra = {}
+
+            self.extra[f] = v
+
+    def __delitem__(self, f):
+        if f not in self:
+            raise KeyError(f)
+
+        if f in self.FIELDS:
+            setattr(self, f, None)
+
+        else:
+            del self.extra[f]
+
+    def __contains__(self, f):
+        if f in self.FIELDS:
+            return getattr(self, f) is not None
+
+        return self.extra is not None and f in self.extra
+
+    def pop(self, f, *default):
+        try:
+            v = self[f]
+
+        except KeyError:
+            if default:
+                return default[0]
+
+            raise
+
+        del self[f]
+        return v
+
+    def keys(self):
+        return [f for f in self.FIELDS if getattr(self, f) is not None] + \
+               (self.extra.keys() if self.extra else [])
+
+    def items(self):
+        return [(f, self[f]) for f in self.keys()]
+
+    def update(self, d):
+        for f, v in d.items():
+            self[f] = v
+
+    def copy(self):
+        """Return a shallow copy, see NotesDB.helper_snapshot_note().
+        """
+
+        n = Note()
+        for f in self.FIELDS:
+            setattr(n, f, getattr(self, f))
+
+        if self.extra:
+            n.extra = self.extra.copy()
+
+        return n
+
+    def __repr__(self):
+        return 'Note(%r)' % (self.to_dict(),)
@@ -1,7 +1,11 @@
+from gi.repository import GLib
 import utils
 from utils import KeyValueObject, SubjectMixin
 from notes_db import NotesDB, SyncError, ReadError, WriteError
 
+# how often the main loop looks for the result of a background search
+SEARCH_POLL_MS = 20
+
 class NotesListModel(SubjectMixin):
     """
     @ivar list: List of (str key, dict note) objects.
@@ -41,6 +45,8 @@ class NotesList():
         self.config = config
         self.notes_list_model = NotesListModel()
         self.model = list_store
+        # called with the number of notes when a fill_threaded() is done
+        self.search_done = None
 
         # read our database of notes into memory
         # and sync with simplenote.
@@ -56,6 +62,37 @@ class NotesList():
     def fill(self, search_string=None):
         # nn is a list of (key, note) objects
         nn, match_regexp, active_notes = self.notes_db.filter_notes(search_string)
+        return self.helper_fill(nn, match_regexp)
+
+    def fill_threaded(self, search_string, done):
+        """Search on the background thread of notes_db, and fill the list
+        from the GTK main loop when the search is done.
+
+        A new search cancels the one before, only the done of the last
+        search is called.
+        """
+
+        polling = self.search_done is not None
+        self.search_done = done
+        self.notes_db.search_threaded(search_string)
+        if not polling:
+            GLib.timeout_add(SEARCH_POLL_MS, self.poll_search)
+
+    def poll_search(self):
+        r = self.notes_db.get_search_result()
+        if r is not None:
+            done = self.search_done
+            self.search_done = None
+            done(self.helper_fill(r.notes, r.match_regexp))
+
+        elif self.notes_db.search_running is None:
+            # replaced by a fill()
+            self.search_done = None
+
+        # keep polling while a search is running
+        return self.search_done is not None
+
+    def helper_fill(self, nn, match_regexp):
         # this will trigger the list_change event
         self.notes_list_model.set_list(nn)
         self.notes_list_model.match_regexp = match_regexp
@@ -99,7 +136,9 @@ class NotesList():
         if idx == -1:
             return False
 
-        return self.notes_list_model.list[idx].note
+        # the list only has the title and snippet of notes that are not in
+        # memory, notes_db gives us the complete note.
+        return self.notes_db.get_note(key)
 
     def search_note_title(self, search_string=None):
         # simple search by iterating through all of the notes...
@@ -138,11 +177,13 @@ class NotesList():
             if really_want_to_exit:
                 # self.view.close()
                 # print 'note: %s' % note
+                self.notes_db.close()
                 print 'closing'
                 return msg
 
         else:
             # self.view.close()
+            self.notes_db.close()
             print 'closing'
 
 
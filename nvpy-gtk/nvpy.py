@@ -78,8 +78,21 @@ class Config:
                     'appdir': app_dir,
                     'home': home,
                     'notes_as_txt': '0',
+                    'txt_watch': '1',
+                    'db_backend': 'json',
+                    'startup_snapshot': '1',
+                    'load_workers': '0',
+                    'compress_threshold': '0',
+                    'shard_depth': '0',
+                    'save_journal': '0',
+                    'lazy_content': '0',
+                    'content_cache_mb': '32',
+                    'cold_content_minutes': '0',
+                    'history_revisions': '0',
                     'housekeeping_interval': '2',
                     'search_mode': 'gstyle',
+                    'search_index': '0',
+                    'background_search': '1',
                     'case_sensitive': '1',
                     'search_tags': '1',
                     'sort_mode': '1',
@@ -128,10 +141,24 @@ class Config:
         self.simplenote_sync = cp.getint(cfg_sec, 'simplenote_sync')
         # make logic to find in $HOME if not set
         self.db_path = cp.get(cfg_sec, 'db_path')
+        # json = one file per note, sqlite = single database file
+        self.db_backend = cp.get(cfg_sec, 'db_backend')
+        self.startup_snapshot = cp.getint(cfg_sec, 'startup_snapshot')
+        self.load_workers = cp.getint(cfg_sec, 'load_workers')
+        self.compress_threshold = cp.getint(cfg_sec, 'compress_threshold')
+        self.shard_depth = cp.getint(cfg_sec, 'shard_depth')
+        self.save_journal = cp.getint(cfg_sec, 'save_journal')
+        self.lazy_content = cp.getint(cfg_sec, 'lazy_content')
+        self.content_cache_mb = cp.getint(cfg_sec, 'content_cache_mb')
+        self.cold_content_minutes = cp.getint(cfg_sec, 'cold_content_minutes')
+        self.history_revisions = cp.getint(cfg_sec, 'history_revisions')
         #  0 = alpha sort, 1 = last modified first
         self.notes_as_txt = cp.getint(cfg_sec, 'notes_as_txt')
         self.txt_path = os.path.join(home, cp.get(cfg_sec, 'txt_path'))
+        self.txt_watch = cp.getint(cfg_sec, 'txt_watch')
         self.search_mode = cp.get(cfg_sec, 'search_mode')
+        self.search_index = cp.getint(cfg_sec, 'search_index')
+        self.background_search = cp.getint(cfg_sec, 'background_search')
         self.case_sensitive = cp.getint(cfg_sec, 'case_sensitive')
         self.search_tags = cp.getint(cfg_sec, 'search_tags')
         self.sort_mode = cp.getint(cfg_sec, 'sort_mode')
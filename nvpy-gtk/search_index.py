@@ -0,0 +1,147 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Substring index over note contents, for gstyle and regexp searches.
+
+A word or phrase can only occur in a content that has all of its trigrams,
+so intersecting the posting sets of those trigrams leaves the few notes
+that still have to be searched. Patterns shorter than a trigram say
+nothing, a search with only those has to look at every note.
+
+Regular expressions are searched the same way, with the literal strings
+that every match must contain as the patterns.
+"""
+
+import sre_constants
+import sre_parse
+
+
+GRAM = 3
+
+
+def grams(s):
+    """Return the set of trigrams of s.
+    """
+
+    return set(s[i:i + GRAM] for i in xrange(len(s) - GRAM + 1))
+
+
+class TrigramIndex(object):
+    """Trigram -> keys of the notes with that trigram in their content.
+
+    With fold, contents and patterns are lowercased first, matching the
+    case insensitive search. Keys that have been added with add_pending()
+    are not indexed yet, and are always candidates.
+    """
+
+    def __init__(self, fold):
+        self.fold = fold
+        # {trigram: set of keys}
+        self.postings = {}
+        # {key: trigrams of its content}, to take it out again
+        self.grams = {}
+        self.pending = set()
+
+    def add_pending(self, keys):
+        self.pending.update(keys)
+
+    def set(self, k, content):
+        """Index the content of note k, replacing what it had.
+        """
+
+        self.remove(k)
+        c = content or u''
+        if self.fold:
+            c = c.lower()
+
+        g = grams(c)
+        for t in g:
+            p = self.postings.get(t)
+            if p is None:
+                p = self.postings[t] = set()
+
+            p.add(k)
+
+        self.grams[k] = g
+
+    def remove(self, k):
+        self.pending.discard(k)
+        for t in self.grams.pop(k, ()):
+            p = self.postings[t]
+            p.discard(k)
+            if not p:
+                del self.postings[t]
+
+    def candidates(self, patterns):
+        """Return the keys of the notes that can contain all patterns.
+
+        @returns: set of keys, or None if the patterns are too short to
+        rule out any note.
+        """
+
+        pg = set()
+        for p in patterns:
+            pg.update(grams(p.lower() if self.fold else p))
+
+        if not pg:
+            return None
+
+        # smallest posting sets first, the intersection only gets smaller
+        ps = sorted((self.postings.get(t, ()) for t in pg), key=len)
+        keys = set(ps[0])
+        for p in ps[1:]:
+            if not keys:
+                break
+
+            keys &= p
+
+        return keys | self.pending
+
+
+def required_literals(pattern, flags=0):
+    """Return the literal strings that every match of pattern contains.
+
+    Only literals that are not optional are found: in foo.*(bar)+ these
+    are foo and bar, in foo|bar there are none.
+
+    @returns: (list of literals, True if the pattern ignores case)
+    """
+
+    try:
+        p = sre_parse.parse(pattern, flags)
+
+    except (sre_constants.error, ValueError, OverflowError):
+        return [], False
+
+    literals = []
+    _collect_literals(p, literals)
+    return literals, bool(p.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE)
+
+
+def _collect_literals(seq, literals):
+    run = []
+    for op, av in seq:
+        if op == sre_constants.LITERAL:
+            try:
+                run.append(unichr(av))
+                continue
+
+            except ValueError:
+                # beyond a narrow unicode build
+                pass
+
+        # whatever this matches ends the current run of literals
+        if run:
+            literals.append(u''.join(run))
+            run = []
+
+        if op == sre_constants.SUBPATTERN:
+            _collect_literals(av[1], literals)
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # at least one copy of the repeated part is in every match
+            _collect_literals(av[2], literals)
+
+    if run:
+        literals.append(u''.join(run))
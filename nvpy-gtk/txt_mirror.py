@@ -0,0 +1,428 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Bookkeeping for the text mirror of notes_as_txt.
+
+NotesDB writes every note to txt_path as a .txt or .mkdn file named after its
+title, and picks up changes made to those files outside of nvPY: at startup
+by comparing the directory with the notes, and while running through one of
+the watchers below.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+from notes_store import replace_file
+
+try:
+    # much faster directory scanning, especially on Windows
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    # not Linux
+    _libc = None
+
+TXT_EXTENSIONS = ('.txt', '.mkdn')
+
+
+def scan(txt_path):
+    """Stat all text notes in txt_path in one pass.
+
+    @returns: {file name: (inode, size, mtime)}
+    """
+
+    if isinstance(txt_path, str):
+        txt_path = unicode(txt_path, 'utf-8')
+
+    files = {}
+    if not os.path.isdir(txt_path):
+        return files
+
+    if scandir is not None:
+        for de in scandir(txt_path):
+            if de.name.endswith(TXT_EXTENSIONS) and de.is_file():
+                files[de.name] = stat_key(de.stat())
+
+    else:
+        for name in os.listdir(txt_path):
+            if name.endswith(TXT_EXTENSIONS):
+                fn = os.path.join(txt_path, name)
+                if os.path.isfile(fn):
+                    files[name] = stat_key(os.stat(fn))
+
+    return files
+
+
+def stat_key(st):
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+class StatCache(object):
+    """Persistent record of the text files as nvPY last wrote or read them.
+
+    For each file name, the cache holds the (inode, size, mtime) the file had
+    at a moment its content was known to match the note with the recorded
+    local key. As long as a file still has exactly that stat, nobody touched
+    it, so startup does not have to compare or read it. Files that have no
+    entry or a different stat fall back to comparing mtimes, which means
+    that an outdated cache, for example after a crash, costs time but never
+    loses changes.
+
+    Entries are recorded by the main thread at startup and by the save
+    worker afterwards. The cache is written to db_path when nvPY exits.
+    """
+
+    # not .json, the json store would take it for a note
+    FILENAME = 'txt_stats.cache'
+    # what the cache was first written as, see remove_legacy()
+    LEGACY_FILENAME = 'txt_stats.json'
+
+    def __init__(self, db_path):
+        self.fname = os.path.join(db_path, self.FILENAME)
+        # {file name: (inode, size, mtime, local key)}
+        self.entries = {}
+
+    @classmethod
+    def remove_legacy(cls, db_path):
+        """Remove a cache that was written as db_path/txt_stats.json.
+
+        Has to happen before the store loads the notes, which would take it
+        for a note.
+        """
+
+        fn = os.path.join(db_path, cls.LEGACY_FILENAME)
+        if os.path.exists(fn):
+            try:
+                os.unlink(fn)
+
+            except OSError, e:
+                logging.error('NotesDB_init: Error removing %s: %s' % (fn, str(e)))
+
+    def load(self):
+        try:
+            with open(self.fname, 'rb') as f:
+                entries = json.load(f)
+
+        except IOError:
+            # no cache yet, everything is compared by mtime.
+            return
+
+        except ValueError, e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (self.fname, str(e)))
+            return
+
+        self.entries = dict((name, tuple(e)) for name, e in entries.iteritems())
+
+    def save(self):
+        entries = self.entries.copy()
+        tfn = self.fname + '.tmp'
+        try:
+            with open(tfn, 'wb') as f:
+                json.dump(entries, f, separators=(',', ':'))
+
+            replace_file(tfn, self.fname)
+
+        except (IOError, OSError), e:
+            # only an optimisation, the next startup compares mtimes instead.
+            logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+
+    def unchanged(self, name, st, key):
+        """Is file name exactly as it was recorded for the note with key?
+        """
+
+        return self.entries.get(name) == st + (key,)
+
+    def owner(self, name):
+        """Local key of the note file name was last recorded for, or None.
+        """
+
+        entry = self.entries.get(name)
+        return entry[3] if entry else None
+
+    def record(self, name, st, key):
+        self.entries[name] = st + (key,)
+
+    def rename(self, old, new):
+        entry = self.entries.pop(old, None)
+        if entry is not None:
+            self.entries[new] = entry
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+
+
+class TitleIndex(object):
+    """Which note owns which text file, in both directions.
+
+    The file name of a note follows from its title, so notes with the same
+    title would share a file. The note that claims a name first keeps it,
+    the others get a suffix made from their key. A note therefore always
+    ends up with the same file name, whatever order notes are saved in,
+    and keeps it for as long as its title does not change.
+
+    Changed by the save worker and read by the main thread, both with
+    NotesDB.txt_lock held.
+    """
+
+    # key characters used for the suffix, before falling back to all of them
+    SUFFIX_LENGTH = 8
+
+    def __init__(self):
+        self.by_key = {}
+        self.by_name = {}
+
+    def name(self, k):
+        return self.by_key.get(k)
+
+    def key(self, name):
+        return self.by_name.get(name)
+
+    def candidates(self, base, k):
+        """File names note k can have with title file name base, in order.
+        """
+
+        root, ext = os.path.splitext(base)
+        return [base,
+                '%s_%s%s' % (root, k[:self.SUFFIX_LENGTH], ext),
+                '%s_%s%s' % (root, k, ext)]
+
+    def choose(self, k, base):
+        """Return the file name note k should use for title file name base.
+        """
+
+        names = self.candidates(base, k)
+        if self.by_key.get(k) in names:
+            # no need to move
+            return self.by_key[k]
+
+        for name in names:
+            if self.by_name.get(name, k) == k:
+                return name
+
+        # only possible if another note is named after our complete key
+        return names[-1]
+
+    def set(self, k, name):
+        self.remove(k)
+        self.by_key[k] = name
+        self.by_name[name] = k
+
+    def remove(self, k):
+        """Forget the file of note k.
+
+        @returns: its file name, or None.
+        """
+
+        name = self.by_key.pop(k, None)
+        if name is not None and self.by_name.get(name) == k:
+            del self.by_name[name]
+
+        return name
+
+    def rekey(self, old, new):
+        name = self.remove(old)
+        if name is not None:
+            self.set(new, name)
+
+
+def find_moves(old, new):
+    """Pair files that disappeared from old with files that appeared in new.
+
+    A renamed file keeps its inode, size and mtime.
+
+    @param old, new: {file name: (inode, size, mtime)}, as returned by scan().
+    @returns: list of (old name, new name).
+    """
+
+    gone = dict((st, name) for name, st in old.iteritems() if name not in new)
+    return [(gone[st], name) for name, st in new.iteritems()
+            if name not in old and st in gone]
+
+
+class Watcher(object):
+    """Collects the names of text files in txt_path that changed.
+
+    A daemon thread watches the directory and take() hands the names that
+    were collected since the last call to the main thread, and the files
+    that were renamed. The watcher does not interpret the changes, NotesDB
+    looks at the files themselves. Subclasses implement run().
+    """
+
+    def __init__(self, txt_path):
+        if isinstance(txt_path, str):
+            txt_path = unicode(txt_path, 'utf-8')
+
+        self.txt_path = txt_path
+        self.lock = threading.Lock()
+        self.changed = set()
+        # [(old name, new name)] of renamed files
+        self.moves = []
+        # set when changes might have been missed
+        self.overflow = False
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def take(self):
+        """Return (set of changed file names, list of (old name, new name)
+        of renamed files) since the last call.
+
+        None instead of the names means that the watcher lost track of what
+        changed, everything has to be looked at again.
+        """
+
+        with self.lock:
+            names, moves, overflow = self.changed, self.moves, self.overflow
+            self.changed = set()
+            self.moves = []
+            self.overflow = False
+
+        return None if overflow else names, moves
+
+    def add(self, names, moves=()):
+        with self.lock:
+            self.changed.update(n for n in names if n.endswith(TXT_EXTENSIONS))
+            for old, new in moves:
+                if old.endswith(TXT_EXTENSIONS) and new.endswith(TXT_EXTENSIONS):
+                    self.moves.append((old, new))
+
+                else:
+                    # from or to a file that is not a text note, for example
+                    # an editor that saves by renaming a temporary file.
+                    self.changed.update(n for n in (old, new) if n.endswith(TXT_EXTENSIONS))
+
+
+class InotifyWatcher(Watcher):
+    """Watcher that is told about changes by the Linux kernel.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    # struct inotify_event without the name that follows it
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, txt_path):
+        Watcher.__init__(self, txt_path)
+
+        self.fd = _libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        path = self.txt_path.encode('utf-8')
+        if _libc.inotify_add_watch(self.fd, path, self.MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, 'inotify_add_watch failed')
+
+    def run(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+
+                logging.error('Watching %s failed: %s' % (self.txt_path, str(e)))
+                return
+
+            names = []
+            moves = []
+            # {cookie: name} of MOVED_FROM events waiting for their MOVED_TO
+            moved_from = {}
+            pos = 0
+            while pos + self.EVENT.size <= len(buf):
+                wd, mask, cookie, length = self.EVENT.unpack_from(buf, pos)
+                pos += self.EVENT.size
+                name = buf[pos:pos + length].rstrip('\0')
+                pos += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    with self.lock:
+                        self.overflow = True
+
+                elif not name:
+                    continue
+
+                name = name.decode('utf-8', 'replace')
+                if mask & self.IN_MOVED_FROM:
+                    moved_from[cookie] = name
+
+                elif mask & self.IN_MOVED_TO and cookie in moved_from:
+                    moves.append((moved_from.pop(cookie), name))
+
+                else:
+                    names.append(name)
+
+            # moved out of txt_path, as far as we can tell
+            names.extend(moved_from.itervalues())
+            self.add(names, moves)
+
+
+class PollingWatcher(Watcher):
+    """Watcher that compares the directory with how it looked before.
+    """
+
+    def __init__(self, txt_path, interval):
+        Watcher.__init__(self, txt_path)
+        self.interval = interval
+        self.files = scan(self.txt_path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                files = scan(self.txt_path)
+
+            except OSError, e:
+                logging.error('Watching %s failed: %s' % (self.txt_path, str(e)))
+                continue
+
+            old = self.files
+            self.files = files
+            moves = find_moves(old, files)
+            moved = set(n for m in moves for n in m)
+            self.add((n for n in set(old) | set(files)
+                      if old.get(n) != files.get(n) and n not in moved), moves)
+
+
+def start_watcher(txt_path, poll_interval=5):
+    """Start watching txt_path with inotify, or by polling if that fails.
+    """
+
+    watcher = None
+    if _libc is not None:
+        try:
+            watcher = InotifyWatcher(txt_path)
+
+        except OSError, e:
+            logging.debug('No inotify for %s, polling instead: %s' % (txt_path, str(e)))
+
+    if watcher is None:
+        watcher = PollingWatcher(txt_path, poll_interval)
+
+    watcher.start()
+    return watcher
@@ -101,12 +101,7 @@ def human_date(timestamp):
 
 
 def note_pinned(n):
-    asystags = n.get('systemtags', 0)
-    # no systemtag at all
-    if not asystags:
-        return 0
-
-    if 'pinned' in asystags:
+    if n.pinned:
         return 1
     else:
         return 0
@@ -120,9 +120,13 @@ class nvpyView(Gtk.Window):
 
         print ('search of {}'.format(search_query))
 
-        notes = self.notes_list.fill(search_query)
+        if self.config.background_search:
+            # typing does not have to wait for the search
+            self.notes_list.fill_threaded(search_query, lambda notes: self.select_note())
 
-        self.select_note()
+        else:
+            notes = self.notes_list.fill(search_query)
+            self.select_note()
 
     def select_note(self, position=0):
         if len(self.notes_list.notes_list_model.list) > 0:
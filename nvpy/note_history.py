@@ -0,0 +1,308 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Local revision history of notes.
+
+Every time the save worker writes a note with new content, the previous
+revisions stay available in db_path/history. Each note has two files there:
+
+- key.hist: the revisions, each a zlib compressed JSON record. Most records
+  only hold the difference with the revision before them, every
+  KEYFRAME_INTERVAL-th record has the complete content.
+- key.idx: one fixed size entry per revision with its number, modifydate and
+  position in key.hist, so that a revision can be found without reading
+  the ones before its keyframe.
+"""
+
+from collections import OrderedDict
+import difflib
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from notes_store import ReadError, WriteError, replace_file
+
+
+class NoteHistory(object):
+    """The revisions of all notes, at most max_revisions per note.
+
+    Pruning only ever cuts at a keyframe, so a note keeps at least
+    max_revisions and at most max_revisions + KEYFRAME_INTERVAL - 1 of them.
+    The save worker adds revisions while the main thread lists and reads
+    them, every method takes self.lock.
+    """
+
+    DIRNAME = 'history'
+    # a complete copy after this many revisions
+    KEYFRAME_INTERVAL = 10
+    # revision number, modifydate, offset and size in .hist, keyframe
+    ENTRY = struct.Struct('<IdQIB')
+    # latest revisions kept in memory, for the notes being edited
+    CACHE_SIZE = 8
+
+    def __init__(self, db_path, max_revisions):
+        self.path = os.path.join(db_path, self.DIRNAME)
+        self.max_revisions = max_revisions
+        self.lock = threading.Lock()
+        # {key: (content, tags)} of the latest revisions, in LRU order. a
+        # note that is saved again does not have to be rebuilt from its
+        # keyframe to diff against.
+        self.latest = OrderedDict()
+
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+    def _fnames(self, k):
+        fn = os.path.join(self.path, k)
+        return fn + '.hist', fn + '.idx'
+
+    def _read_index(self, k):
+        hfn, ifn = self._fnames(k)
+        try:
+            with open(ifn, 'rb') as f:
+                data = f.read()
+
+        except IOError:
+            # no history yet
+            return []
+
+        size = self.ENTRY.size
+        # an entry cut short by a crash is ignored
+        return [self.ENTRY.unpack_from(data, pos)
+                for pos in xrange(0, len(data) - size + 1, size)]
+
+    def _read_records(self, k, entries):
+        """Return the records of consecutive index entries, in one read.
+        """
+
+        if not entries:
+            return []
+
+        hfn, ifn = self._fnames(k)
+        start = entries[0][2]
+        end = entries[-1][2] + entries[-1][3]
+        with open(hfn, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+        return [json.loads(zlib.decompress(data[e[2] - start:e[2] - start + e[3]]))
+                for e in entries]
+
+    def _content_at(self, k, entries, i):
+        """Rebuild revision entries[i] from its keyframe onwards.
+
+        @returns: (content, tags)
+        """
+
+        start = i
+        while not entries[start][4]:
+            start -= 1
+
+        lines = None
+        for r in self._read_records(k, entries[start:i + 1]):
+            if 'c' in r:
+                lines = r['c'].splitlines(True)
+
+            else:
+                lines = apply_delta(lines, r['d'])
+
+        return u''.join(lines), r['g']
+
+    def add(self, k, content, tags, modifydate):
+        """Record a new revision of note k.
+        """
+
+        with self.lock:
+            try:
+                self._add(k, content or u'', list(tags or ()), modifydate)
+
+            except (IOError, OSError, ValueError, zlib.error), e:
+                # losing a revision is no reason to stop saving notes.
+                logging.error('NotesDB_save: Error writing history of %s: %s' % (k, str(e)))
+
+    def _add(self, k, content, tags, modifydate):
+        entries = self._read_index(k)
+        lines = content.splitlines(True)
+
+        record = None
+        if entries:
+            latest = self.latest.pop(k, None)
+            if latest is not None:
+                old_content, old_tags = latest
+
+            else:
+                old_content, old_tags = self._content_at(k, entries, len(entries) - 1)
+
+            self._remember(k, old_content, old_tags)
+            if old_content == content and old_tags == tags:
+                return
+
+            last = len(entries) - 1
+            while not entries[last][4]:
+                last -= 1
+
+        if entries and len(entries) - last < self.KEYFRAME_INTERVAL:
+            delta = make_delta(old_content.splitlines(True), lines)
+            # a delta that is not smaller than the content is no use
+            if sum(len(d) for d in delta if not isinstance(d, list)) < len(content):
+                record = {'g': tags, 'd': delta}
+
+        if record is None:
+            record = {'g': tags, 'c': content}
+
+        data = zlib.compress(json.dumps(record, separators=(',', ':')))
+        rev = entries[-1][0] + 1 if entries else 1
+
+        hfn, ifn = self._fnames(k)
+        with open(hfn, 'ab') as f:
+            # the end of the file, whatever a crash might have left there
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+
+        entry = (rev, modifydate, offset, len(data), int('c' in record))
+        with open(ifn, 'ab') as f:
+            f.write(self.ENTRY.pack(*entry))
+
+        entries.append(entry)
+        self._remember(k, content, tags)
+        self._prune(k, entries)
+
+    def _remember(self, k, content, tags):
+        self.latest.pop(k, None)
+        self.latest[k] = (content, tags)
+        while len(self.latest) > self.CACHE_SIZE:
+            self.latest.popitem(last=False)
+
+    def _prune(self, k, entries):
+        if len(entries) <= self.max_revisions:
+            return
+
+        # the last keyframe that leaves at least max_revisions
+        cut = len(entries) - self.max_revisions
+        while cut > 0 and not entries[cut][4]:
+            cut -= 1
+
+        if not cut:
+            return
+
+        hfn, ifn = self._fnames(k)
+        start = entries[cut][2]
+        with open(hfn, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+
+        with open(hfn + '.tmp', 'wb') as f:
+            f.write(data)
+
+        with open(ifn + '.tmp', 'wb') as f:
+            for e in entries[cut:]:
+                f.write(self.ENTRY.pack(e[0], e[1], e[2] - start, e[3], e[4]))
+
+        replace_file(hfn + '.tmp', hfn)
+        replace_file(ifn + '.tmp', ifn)
+
+    def revisions(self, k):
+        """Return [(revision number, modifydate)] of note k, oldest first.
+        """
+
+        with self.lock:
+            return [(e[0], e[1]) for e in self._read_index(k)]
+
+    def get(self, k, rev):
+        """Return (content, tags) of revision rev of note k.
+        """
+
+        with self.lock:
+            entries = self._read_index(k)
+            for i, e in enumerate(entries):
+                if e[0] == rev:
+                    break
+
+            else:
+                raise KeyError(rev)
+
+            try:
+                return self._content_at(k, entries, i)
+
+            except (IOError, ValueError, zlib.error), e:
+                logging.error('NotesDB_history: Error reading history of %s: %s' % (k, str(e)))
+                raise ReadError('Error reading note history')
+
+    def delete(self, k):
+        with self.lock:
+            self.latest.pop(k, None)
+            for fn in self._fnames(k):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+    def rename(self, old, new):
+        """The note got a new key from the server.
+        """
+
+        with self.lock:
+            latest = self.latest.pop(old, None)
+            if latest is not None:
+                self.latest[new] = latest
+
+            try:
+                for ofn, nfn in zip(self._fnames(old), self._fnames(new)):
+                    if os.path.exists(ofn):
+                        replace_file(ofn, nfn)
+
+            except OSError, e:
+                logging.error('NotesDB_save: Error renaming history of %s: %s' % (old, str(e)))
+                raise WriteError('Error writing note history')
+
+
+def make_delta(old, new):
+    """Return how to make list of lines new from list of lines old.
+
+    The delta is a list of [i1, i2], lines old[i1:i2], and strings to
+    insert.
+    """
+
+    # an edit usually touches a few lines somewhere in the middle. only
+    # those are diffed, SequenceMatcher is slow on long runs of repeated
+    # lines like empty ones.
+    start = 0
+    end = min(len(old), len(new))
+    while start < end and old[start] == new[start]:
+        start += 1
+
+    tail = 0
+    while tail < end - start and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+
+    delta = []
+    if start:
+        delta.append([0, start])
+
+    sm = difflib.SequenceMatcher(None, old[start:len(old) - tail], new[start:len(new) - tail])
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == 'equal':
+            delta.append([start + i1, start + i2])
+
+        elif j2 > j1:
+            delta.append(u''.join(new[start + j1:start + j2]))
+
+    if tail:
+        delta.append([len(old) - tail, len(old)])
+
+    return delta
+
+
+def apply_delta(old, delta):
+    lines = []
+    for d in delta:
+        if isinstance(d, list):
+            lines.extend(old[d[0]:d[1]])
+
+        else:
+            lines.extend(d.splitlines(True))
+
+    return lines
@@ -3,36 +3,220 @@
 # new BSD license
 
 import codecs
-import copy
-import glob
-import os
+from collections import OrderedDict
+import hashlib
 import json
+import os
 import logging
 from Queue import Queue, Empty
 import re
+import search_index
 import simplenote
 simplenote.NOTE_FETCH_LENGTH = 100
 from simplenote import Simplenote
 
-from threading import Thread
+from threading import Condition, Lock, Thread
 import time
 import utils
+import zlib
+from note_record import Note
+import note_history
+import notes_store
+from notes_store import ReadError, WriteError, replace_file
+import txt_mirror
 
 ACTION_SAVE = 0
 ACTION_SYNC_PARTIAL_TO_SERVER = 1
 ACTION_SYNC_PARTIAL_FROM_SERVER = 2  # UNUSED.
+ACTION_PURGE = 3
+
+# with lazy_content, evicted notes keep their title line and this many
+# characters after it in memory, for the notes list.
+CONTENT_STUB_LENGTH = 200
+
+# number of recent gstyle searches that later ones can refine
+SEARCH_CACHE_SIZE = 8
+# a background search checks whether it was cancelled after this many notes
+SEARCH_CHECK_INTERVAL = 256
 
 
 class SyncError(RuntimeError):
     pass
 
 
-class ReadError(RuntimeError):
-    pass
+class SaveQueue:
+    """Queue of notes waiting to be written to disc, at most one per key.
+
+    Putting a newer copy of a note that has not been picked up by the save
+    worker yet replaces the older copy, so a slow disc never has to write
+    versions that are already outdated. The worker takes everything that is
+    pending in one go and writes it in one pass.
+    """
 
+    def __init__(self):
+        self.cond = Condition()
+        # {local key: save action}, in the order they were first queued
+        self.pending = OrderedDict()
+        # number of notes the worker is writing at the moment
+        self.in_progress = 0
 
-class WriteError(RuntimeError):
-    pass
+    def put_batch(self, ol):
+        """Queue all save actions in ol.
+
+        @returns: set of keys for which an unwritten copy was replaced.
+        """
+
+        replaced = set()
+        with self.cond:
+            for o in ol:
+                if o.key in self.pending:
+                    replaced.add(o.key)
+
+                self.pending[o.key] = o
+
+            if ol:
+                self.cond.notify()
+
+        return replaced
+
+    def get_batch(self):
+        """Wait for pending saves, then take all of them.
+
+        Call task_done() when they have been written.
+        """
+
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+
+            batch = self.pending.values()
+            self.pending = OrderedDict()
+            self.in_progress = len(batch)
+
+        return batch
+
+    def task_done(self):
+        with self.cond:
+            self.in_progress = 0
+
+    def qsize(self):
+        """Number of notes waiting to be written or being written.
+        """
+
+        with self.cond:
+            return len(self.pending) + self.in_progress
+
+
+class SyncOutbox(object):
+    """Durable record of what still has to go to the server.
+
+    pending has the local keys of notes with changes that the server does
+    not have yet. The save worker adds notes to it before it writes them
+    and removes them after it has written them synced, so every unsynced
+    change on disc is in the outbox. At startup, the sync resumes from it
+    instead of comparing the dates of all notes.
+
+    keys has {local key: server key} of new notes that the server has
+    created, until they have been written with their server key. This is
+    recorded as soon as the server replies, so that after a crash the next
+    upload updates the note instead of creating it again.
+
+    When the outbox cannot be written, its file is removed: the next
+    startup then falls back to comparing dates.
+    """
+
+    # not .json, the json store would take it for a note
+    FILENAME = 'sync.outbox'
+
+    def __init__(self, db_path):
+        self.fname = os.path.join(db_path, self.FILENAME)
+        self.lock = Lock()
+        self.pending = set()
+        self.keys = {}
+
+    def load(self):
+        """Read the outbox.
+
+        @returns: False if there was none to read.
+        """
+
+        try:
+            with open(self.fname, 'rb') as f:
+                d = json.load(f)
+
+        except IOError:
+            return False
+
+        except ValueError, e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (self.fname, str(e)))
+            return False
+
+        self.pending = set(d.get('pending', []))
+        self.keys = d.get('keys', {})
+        return True
+
+    def save(self):
+        with self.lock:
+            d = {'pending': list(self.pending), 'keys': self.keys}
+            tfn = self.fname + '.tmp'
+            try:
+                with open(tfn, 'wb') as f:
+                    json.dump(d, f, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                replace_file(tfn, self.fname)
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                try:
+                    os.unlink(self.fname)
+
+                except OSError:
+                    pass
+
+    def update(self, add=(), remove=(), forget=()):
+        """Add local keys to and remove them from pending, forget the
+        server keys of notes in forget, and save if that changed anything.
+        """
+
+        with self.lock:
+            add = set(add) - self.pending
+            remove = self.pending.intersection(remove)
+            forget = [k for k in forget if k in self.keys]
+            self.pending |= add
+            self.pending -= remove
+            for k in forget:
+                del self.keys[k]
+
+        if add or remove or forget:
+            self.save()
+
+    def set_key(self, k, key):
+        """The server created new note k with key.
+        """
+
+        self.set_keys({k: key})
+
+    def set_keys(self, keys):
+        """The server created the new notes in keys, {local key: server key}.
+        """
+
+        if not keys:
+            return
+
+        with self.lock:
+            self.keys.update(keys)
+
+        self.save()
+
+    def prune(self, live):
+        """Forget about all notes that are not in live.
+        """
+
+        with self.lock:
+            self.pending = set(k for k in self.pending if live(k))
+            self.keys = dict((k, key) for k, key in self.keys.items() if live(k))
 
 
 class NotesDB(utils.SubjectMixin):
@@ -53,98 +237,249 @@ class NotesDB(utils.SubjectMixin):
         if self.config.notes_as_txt and not os.path.exists(config.txt_path):
             os.mkdir(config.txt_path)
 
+        # the stat cache of the text mirror used to be a .json file in db_path
+        txt_mirror.StatCache.remove_legacy(self.db_path)
+
+        # the store takes care of the on-disc format of the notes database.
+        self.store = notes_store.open_store(config)
+
+        # earlier contents of the notes, added to by the save worker.
+        if self.config.history_revisions:
+            self.history = note_history.NoteHistory(self.db_path, self.config.history_revisions)
+
+        else:
+            self.history = None
+
+        # with lazy_content, only the most recently used note contents are
+        # kept in memory. the content of the other notes is replaced by a
+        # title / snippet stub and read from the store when needed.
+        # content_cache: {local key: size} of full contents in LRU order
+        self.content_cache = OrderedDict()
+        self.content_cache_size = 0
+        self.content_cache_budget = self.config.content_cache_mb * 1024 * 1024
+        # keys of notes that only have their stub in memory
+        self.lazy_keys = set()
+
+        # without lazy_content, cold_content_minutes keeps the contents of
+        # notes that were not used for that long compressed in memory. like
+        # an evicted note, the note itself then only has its stub.
+        if self.config.cold_content_minutes and not self.config.lazy_content:
+            self.cold_after = self.config.cold_content_minutes * 60
+
+        else:
+            self.cold_after = 0
+
+        # {local key: (zlib compressed utf-8 content, length of the content)}
+        self.cold_content = {}
+        # {local key: time of last use} of uncompressed contents in LRU order
+        self.content_used = OrderedDict()
+        # for get_cold_content_stats()
+        self.cold_raw_size = 0
+        self.cold_size = 0
+        self.content_accesses = 0
+        self.cold_decompressions = 0
+
+        # with search_index, gstyle searches only look at the notes that
+        # the trigram index of their case mode finds: {fold: TrigramIndex}.
+        # changed notes are indexed again by update_search_index().
+        self.search_indexes = {}
+        # [query, keys] of recent gstyle searches, newest last. a query that
+        # refines one of them only has to look at its keys, see
+        # helper_refine_candidates(). notes that change are added to all
+        # of them, they might match now.
+        self.search_cache = []
+        # search_threaded() numbers its searches, only the results of the
+        # latest are wanted. search_running is its snapshot until then.
+        self.search_generation = 0
+        self.search_running = None
+
+        # keys of notes that might have to be saved or synced. housekeeping
+        # only looks at these, instead of checking the dates of all notes.
+        self.dirty_save = set()
+        self.dirty_sync = set()
+        # {local key: number of copies} on the save queue or being written
+        self.saves_in_flight = {}
+        # {local key: (content hash, metadata hash)} of what was last written
+        # to disc, so that the save worker can skip writes that would not
+        # change anything. only the save worker touches this after startup.
+        self.save_hashes = {}
+
         now = time.time()
-        # now read all .json files from disk
-        fnlist = glob.glob(self.helper_key_to_fname('*'))
-        txtlist = glob.glob(unicode(self.config.txt_path + '/*.txt', 'utf-8'))
-        txtlist += glob.glob(unicode(self.config.txt_path + '/*.mkdn', 'utf-8'))
+        if self.config.notes_as_txt:
+            # {file name: (inode, size, mtime)} of all text notes, in one pass
+            txtfiles = txt_mirror.scan(self.config.txt_path)
+            self.txt_stats = txt_mirror.StatCache(self.db_path)
+            self.txt_stats.load()
+
+        else:
+            txtfiles = {}
 
         # removing json files and force full full sync if using text files
         # and none exists and json files are there
-        if self.config.notes_as_txt and not txtlist and fnlist:
-            logging.debug('Forcing resync: using text notes, first usage')
-            for fn in fnlist:
-                os.unlink(fn)
-            fnlist = []
+        if self.config.notes_as_txt and not txtfiles:
+            keylist = self.store.keys()
+            if keylist:
+                logging.debug('Forcing resync: using text notes, first usage')
+                for k in keylist:
+                    self.store.delete(k)
+
+        # with sync, the outbox says which notes wait for the server.
+        self.sync_outbox = None
+        outbox_loaded = False
+        if self.config.simplenote_sync:
+            self.sync_outbox = SyncOutbox(self.db_path)
+            outbox_loaded = self.sync_outbox.load()
 
         self.notes = {}
+        # {local key: note} of deleted notes, until the server has confirmed
+        # the deletion. only saving and syncing look at these, searching and
+        # counting only ever sees the live notes in self.notes.
+        self.tombstones = {}
+        # {tag: [interned tag, number of live notes with it]}. all live
+        # notes share the interned tag strings.
+        self.tag_table = {}
+        # list of the tags in tag_table, until that changes
+        self.tag_list = None
         if self.config.notes_as_txt:
-            self.titlelist = {}
+            self.titles = txt_mirror.TitleIndex()
+            txtstats = {}
+
+        # now read all notes from the store
+        # we always have a localkey, also when we don't have a note['key'] yet (no sync)
+        for localkey, n, mtime in self.store.load_all():
+            n = Note.from_dict(n)
+            if not n.key and outbox_loaded and localkey in self.sync_outbox.keys:
+                # the server created this note, but we crashed before
+                # writing its key.
+                n.key = self.sync_outbox.keys[localkey]
+
+            if n.deleted and n.modifydate <= (n.syncdate or 0):
+                # the server already has this deletion
+                self.store.delete(localkey)
+                continue
 
-        for fn in fnlist:
-            try:
-                n = json.load(open(fn, 'rb'))
-                if self.config.notes_as_txt:
-                    nt = utils.get_note_title_file(n)
-                    tfn = os.path.join(self.config.txt_path, nt)
-                    if os.path.isfile(tfn):
-                        self.titlelist[n.get('key')] = nt
-                        txtlist.remove(tfn)
-                        if os.path.getmtime(tfn) > os.path.getmtime(fn):
-                            logging.debug('Text note was changed: %s' % (fn,))
-                            with codecs.open(tfn, mode='rb', encoding='utf-8') as f:
-                                c = f.read()
-
-                            n['content'] = c
-                            n['modifydate'] = os.path.getmtime(tfn)
-                    else:
-                        logging.debug('Deleting note : %s' % (fn,))
-                        if not self.config.simplenote_sync:
-                            os.unlink(fn)
-                            continue
-                        else:
-                            n['deleted'] = 1
-                            n['modifydate'] = now
+            changed = False
+            if self.config.notes_as_txt and not n.deleted:
+                # a suffixed name is ours for sure, the plain one only if
+                # the stat cache does not say it belongs to another note.
+                base = utils.get_note_title_file(n)
+                nt = st = None
+                for name in reversed(self.titles.candidates(base, localkey)):
+                    if name in txtfiles and self.titles.key(name) is None and \
+                            self.txt_stats.owner(name) in (None, localkey):
+                        nt, st = name, txtfiles[name]
+                        break
+
+                if st is not None:
+                    self.titles.set(localkey, nt)
+                    # a file that still has the stat we recorded for this
+                    # note has not been touched, whatever its mtime.
+                    if not self.txt_stats.unchanged(nt, st, localkey) and st[2] > mtime:
+                        logging.debug('Text note was changed: %s' % (localkey,))
+                        n['content'] = self.helper_read_txt(nt)
+                        n['modifydate'] = st[2]
+                        changed = True
+
+                    txtstats[nt] = st + (localkey,)
+
+                elif base in txtfiles:
+                    # the file of another note with the same title, this
+                    # note gets its own.
+                    logging.debug('Text note shares its file: %s' % (localkey,))
+                    changed = True
 
-            except IOError, e:
-                logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
-                raise ReadError('Error opening note file')
+                else:
+                    logging.debug('Deleting note : %s' % (localkey,))
+                    if not self.config.simplenote_sync:
+                        self.store.delete(localkey)
+                        continue
+                    else:
+                        n['deleted'] = 1
+                        n['modifydate'] = now
+                        changed = True
 
-            except ValueError, e:
-                logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
-                raise ReadError('Error reading note file')
+            if n.deleted:
+                self.tombstones[localkey] = n
 
             else:
-                # we always have a localkey, also when we don't have a note['key'] yet (no sync)
-                localkey = os.path.splitext(os.path.basename(fn))[0]
                 self.notes[localkey] = n
+                self.helper_add_tags(n)
+
+            if self.config.notes_as_txt and not n.deleted:
+                # the text mirror has just been found matching this content
+                self.save_hashes[localkey] = (self.helper_content_hash(n), None)
+
+            if changed:
+                # the text mirror is newer than what we have on disc
+                n['savedate'] = 0
+                self.helper_note_changed(localkey)
+
+            else:
                 # we maintain in memory a timestamp of the last save
                 # these notes have just been read, so at this moment
                 # they're in sync with the disc.
                 n['savedate'] = now
 
-        if self.config.notes_as_txt:
-            for fn in txtlist:
-                logging.debug('New text note found : %s' % (fn),)
-                tfn = os.path.join(self.config.txt_path, fn)
-                try:
-                    with codecs.open(tfn, mode='rb', encoding='utf-8') as f:
-                        c = f.read()
+            if not outbox_loaded and n.modifydate > (n.syncdate or 0):
+                # changed since the last sync, possibly in a previous session
+                self.dirty_sync.add(localkey)
 
-                except IOError, e:
-                    logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
-                    raise ReadError('Error opening note file')
+        # make what was removed above durable
+        self.store.sync()
 
-                except ValueError, e:
-                    logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
-                    raise ReadError('Error reading note file')
+        if outbox_loaded:
+            # changed since the last sync in a previous session. notes that
+            # are gone got another key in a full sync, or were purged.
+            self.sync_outbox.prune(lambda k: k in self.notes or k in self.tombstones)
+            self.dirty_sync.update(self.sync_outbox.pending)
 
-                else:
-                    nk = self.create_note(c)
-                    nn = os.path.splitext(os.path.basename(fn))[0]
-                    if nn != utils.get_note_title(self.notes[nk]):
-                        self.notes[nk]['content'] = nn + "\n\n" + c
+        elif self.sync_outbox is not None:
+            # from now on, the outbox knows. the workers have not started
+            # yet, and it is written even when nothing is pending.
+            self.sync_outbox.pending.update(self.dirty_sync)
+            self.sync_outbox.save()
+
+        if self.config.notes_as_txt:
+            # only files that matched a note are worth remembering
+            self.txt_stats.entries = txtstats
 
-                    os.unlink(tfn)
+            for fn in sorted(f for f in txtfiles if self.titles.key(f) is None):
+                logging.debug('New text note found : %s' % (fn),)
+                self.helper_import_txt(fn, self.helper_read_txt(fn))
 
         # save and sync queue
-        self.q_save = Queue()
+        self.q_save = SaveQueue()
         self.q_save_res = Queue()
 
+        # set when notes have been saved since the last startup snapshot.
+        # we start out outdated, the first idle housekeeping writes one.
+        self.snapshot_outdated = True
+
+        # held by the save worker while it changes the text mirror, so that
+        # process_txt_changes() never sees a file it wrote half-registered.
+        self.txt_lock = Lock()
+
         thread_save = Thread(target=self.worker_save)
         thread_save.setDaemon(True)
         thread_save.start()
 
+        # from now on, changes to the text mirror are picked up as they
+        # happen and applied by process_txt_changes().
+        self.txt_watcher = None
+        if self.config.notes_as_txt and self.config.txt_watch:
+            self.txt_watcher = txt_mirror.start_watcher(self.config.txt_path)
+
+        # names of changed text files that have to wait for pending saves
+        self.txt_pending = set()
+
+        # searches for search_threaded() and their results
+        self.q_search = Queue()
+        self.q_search_res = Queue()
+
+        thread_search = Thread(target=self.worker_search)
+        thread_search.setDaemon(True)
+        thread_search.start()
+
         # initialise the simplenote instance we're going to use
         # this does not yet need network access
         if self.config.simplenote_sync:
@@ -167,6 +502,22 @@ class NotesDB(utils.SubjectMixin):
             thread_sync.setDaemon(True)
             thread_sync.start()
 
+        if self.config.lazy_content:
+            # most recently modified notes are the last to be evicted
+            for k in sorted(self.notes, key=lambda k: self.notes[k].modifydate):
+                self.helper_cache_content(k)
+
+            self.helper_evict_content()
+
+        elif self.cold_after:
+            # least recently modified notes are the first to be compressed
+            for k in sorted(self.notes, key=lambda k: self.notes[k].modifydate):
+                self.helper_cache_content(k)
+
+        if self.config.search_index:
+            # housekeeping can start filling it.
+            self.helper_get_search_index()
+
     def create_note(self, title):
         # need to get a key unique to this database. not really important
         # what it is, as long as it's unique.
@@ -177,23 +528,140 @@ class NotesDB(utils.SubjectMixin):
         timestamp = time.time()
 
         # note has no internal key yet.
-        new_note = {
+        new_note = Note({
             'content': title,
             'modifydate': timestamp,
             'createdate': timestamp,
             'savedate': 0,  # never been written to disc
             'syncdate': 0,  # never been synced with server
             'tags': []
-        }
+        })
 
         self.notes[new_key] = new_note
+        self.helper_cache_content(new_key)
+        self.helper_index_changed(new_key)
+        self.helper_note_changed(new_key)
 
         return new_key
 
+    def process_txt_changes(self):
+        """Apply changes that other programs made to the text mirror.
+
+        This is called by housekeeping on the main thread. Files of notes
+        that still have changes waiting to be saved are left for a later
+        call: nvPY is about to overwrite them, so edits made in nvPY win.
+
+        @returns: list of local keys of notes that were changed or created.
+        """
+
+        if self.txt_watcher is None:
+            return []
+
+        names, moves = self.txt_watcher.take()
+        if names is None:
+            # the watcher lost track, look at everything
+            names = set(txt_mirror.scan(self.config.txt_path))
+            names.update(self.titles.by_name)
+
+        names |= self.txt_pending
+        self.txt_pending = set()
+        if not names and not moves:
+            return []
+
+        with self.txt_lock:
+            names |= self.helper_apply_txt_moves(moves)
+            return self.helper_apply_txt_changes(names)
+
+    def helper_apply_txt_moves(self, moves):
+        """Let notes keep their text files when those are renamed.
+
+        The note is not deleted and imported again, so it keeps its key,
+        tags and history. Its file name follows its title again the next
+        time it is saved.
+
+        @returns: set of file names that still have to be looked at.
+        """
+
+        # with self.txt_lock held
+        names = set()
+        for old, new in moves:
+            k = self.titles.key(old)
+            if k in self.notes and self.titles.key(new) is None:
+                logging.debug('Text note was renamed: %s -> %s' % (old, new))
+                self.titles.set(k, new)
+                self.txt_stats.rename(old, new)
+                # in case it was changed as well
+                names.add(new)
+
+            else:
+                # not one of our files, or moved over another note's file
+                names.update((old, new))
+
+        return names
+
+    def helper_apply_txt_changes(self, names):
+        # with self.txt_lock held
+        changed = []
+        for name in sorted(names):
+            k = self.titles.key(name)
+            if k in self.tombstones:
+                # the save worker is about to remove its file
+                continue
+
+            if k not in self.notes:
+                k = None
+
+            if k is not None and not self.helper_note_saved(k):
+                self.txt_pending.add(name)
+                continue
+
+            try:
+                st = txt_mirror.stat_key(os.stat(os.path.join(self.config.txt_path, name)))
+
+            except OSError:
+                st = None
+
+            if st is None:
+                if k is not None:
+                    logging.debug('Text note was deleted: %s' % (k,))
+                    self.delete_note(k)
+                    changed.append(k)
+
+                continue
+
+            if k is not None and self.txt_stats.unchanged(name, st, k):
+                # written by the save worker
+                continue
+
+            try:
+                c = self.helper_read_txt(name)
+
+            except ReadError:
+                # probably still being written, the next event tells us.
+                continue
+
+            if k is None:
+                logging.debug('New text note found : %s' % (name,))
+                changed.append(self.helper_import_txt(name, c))
+
+            elif c != self.get_note_content(k):
+                logging.debug('Text note was changed: %s' % (k,))
+                self.set_note_content(k, c)
+                changed.append(k)
+
+        return changed
+
     def delete_note(self, key):
         n = self.notes[key]
-        n['deleted'] = 1
-        n['modifydate'] = time.time()
+        n.deleted = True
+        n.modifydate = time.time()
+        self.helper_bury(key)
+        if self.config.simplenote_sync:
+            # the server has to be told, the tombstone stays until it has.
+            self.helper_note_changed(key)
+
+        else:
+            self.helper_purge(key)
 
     def filter_notes(self, search_string=None):
         """Return list of notes filtered with search string.
@@ -210,31 +678,280 @@ class NotesDB(utils.SubjectMixin):
         total number of notes in memory.
         """
 
-        if self.config.search_mode == 'regexp':
-            filtered_notes, match_regexp, active_notes = self.filter_notes_regexp(search_string)
+        # a background search that is still running is outdated now
+        self.search_generation += 1
+        self.search_running = None
+
+        s = self.helper_search_snapshot(search_string)
+        return self.helper_search_done(s, self.helper_search(s))
+
+    def search_threaded(self, search_string=None):
+        """Start filter_notes(search_string) on the search worker.
+
+        The worker only looks at a snapshot of the notes that can match,
+        taken right here, so the notes can change while it runs. A new
+        search, threaded or not, cancels the one that is running.
+
+        @return: generation number of this search, see get_search_result().
+        """
+
+        self.search_generation += 1
+        s = self.helper_search_snapshot(search_string)
+        s.generation = self.search_generation
+        self.search_running = s
+        self.q_search.put(s)
+
+        return s.generation
+
+    def get_search_result(self):
+        """Return the result of the last search_threaded() when it is done.
+
+        Called by the UI from its main loop until search_running is None.
+        Results of searches that have been replaced by newer ones are
+        dropped.
+
+        @return: None if there is no new result, otherwise an object with
+        the generation of the search and the notes, match_regexp and
+        active_notes that filter_notes() returns.
+        """
+
+        while True:
+            try:
+                s, r = self.q_search_res.get_nowait()
+
+            except Empty:
+                return None
+
+            if s.generation == self.search_generation:
+                notes, match_regexp, active_notes = self.helper_search_done(s, r)
+                return utils.KeyValueObject(generation=s.generation, notes=notes,
+                                            match_regexp=match_regexp, active_notes=active_notes)
+
+    def helper_search_snapshot(self, search_string):
+        """Prepare search_string for helper_search(), which might run on
+        the search worker.
+
+        Everything that needs the notes themselves happens here, on the
+        main thread: the query is parsed, the candidates are found and
+        their keys, contents and tags are taken. Contents and tags are
+        replaced when they change, never changed in place, so the snapshot
+        keeps the ones the search started with.
+        """
+
+        cfg = self.config
+        s = utils.KeyValueObject(search_string=search_string, generation=None,
+                                 regexp=cfg.search_mode == 'regexp',
+                                 case_sensitive=cfg.case_sensitive,
+                                 search_tags=cfg.search_tags, sort_mode=cfg.sort_mode,
+                                 pinned_ontop=cfg.pinned_ontop,
+                                 # deleted notes are not in self.notes
+                                 active_notes=len(self.notes),
+                                 query=None, changed=set(), decompressions=0)
+
+        if s.regexp:
+            keys, maybe = self.helper_snapshot_regexp(s)
+
         else:
-            filtered_notes, match_regexp, active_notes = self.filter_notes_gstyle(search_string)
+            keys, maybe = self.helper_snapshot_gstyle(s)
+
+        if keys is None:
+            keys = self.notes
+
+        s.entries = [self.helper_snapshot_entry(k, maybe is None or k in maybe)
+                     for k in keys if k in self.notes]
+
+        return s
+
+    def helper_snapshot_entry(self, k, maybe):
+        """Return (key, note, content, lowercased content or None,
+        evicted, tags, maybe) of note k for a search snapshot.
+
+        The content of an evicted note is not in memory: evicted is True
+        for a lazy note, which is read from the store, and the compressed
+        content of a cold one. Only notes with maybe can match on content.
+        """
+
+        n = self.notes[k]
+        evicted = None
+        if k in self.lazy_keys:
+            evicted = True
+
+        elif k in self.cold_content:
+            evicted = self.cold_content[k][0]
+
+        return k, n, n.content, n.get_folded(), evicted, n.tags, maybe
+
+    def helper_snapshot_gstyle(self, s):
+        """Parse the gstyle query of search s.
+
+        @return: (keys of the notes that can match or None for all notes,
+        None)
+        """
+
+        s.tag_pats = s.word_pats = ()
+        s.match_regexp = []
+        if not s.search_string:
+            return None, None
+
+        # group0: ag - not used
+        # group1: t(ag)?:([^\s]+)
+        # group2: multiple words in quotes
+        # group3: single words
+        # example result for 't:tag1 t:tag2 word1 "word2 word3" tag:tag3' ==
+        # [('', 'tag1', '', ''), ('', 'tag2', '', ''), ('', '', '', 'word1'), ('', '', 'word2 word3', ''), ('ag', 'tag3', '', '')]
+
+        groups = re.findall('t(ag)?:([^\s]+)|"([^"]+)"|([^\s]+)', s.search_string)
+        tms_pats = [[] for _ in range(3)]
+
+        # we end up with [[tag_pats],[multi_word_pats],[single_word_pats]]
+        for gi in groups:
+            for mi in range(1, 4):
+                if gi[mi]:
+                    tms_pats[mi - 1].append(gi[mi])
+
+        s.match_regexp = '|'.join(tms_pats[1] + tms_pats[2])
+
+        msword_pats = tms_pats[1] + tms_pats[2]
+        if not s.case_sensitive:
+            msword_pats = [p.lower() for p in msword_pats]
+
+        s.tag_pats = tuple(tms_pats[0])
+        s.word_pats = tuple(msword_pats)
+        s.query = (bool(s.case_sensitive), s.tag_pats, s.word_pats)
+
+        # while typing, the new query usually refines the previous one
+        keys = self.helper_refine_candidates(s.query)
+        if self.config.search_index:
+            # only the notes that can contain all words need checking
+            ikeys = self.helper_get_search_index().candidates(tms_pats[1] + tms_pats[2])
+            if ikeys is not None:
+                keys = ikeys if keys is None else keys & ikeys
+
+        return keys, None
+
+    def helper_snapshot_regexp(self, s):
+        """Compile the regular expression of search s.
+
+        @return: (keys of the notes that can match or None for all notes,
+        keys of the notes whose content can match or None for all notes)
+        """
+
+        sspat = None
+        if s.search_string:
+            try:
+                if s.case_sensitive == 0:
+                    sspat = re.compile(s.search_string, re.I)
+                else:
+                    sspat = re.compile(s.search_string)
+            except re.error:
+                pass
+
+        s.sspat = sspat
+        s.match_regexp = s.search_string if sspat else ''
 
-        if self.config.sort_mode == 0:
-            if self.config.pinned_ontop == 0:
+        keys = None
+        if sspat and self.config.search_index:
+            literals, fold = search_index.required_literals(s.search_string, sspat.flags)
+            keys = self.helper_get_search_index(fold).candidates(literals)
+
+        # a note whose content cannot match can still match on its tags
+        return keys if s.search_tags != 1 else None, keys
+
+    def helper_search(self, s):
+        """Filter and sort the notes in the snapshot of search s.
+
+        Runs on the search worker for search_threaded(), which is why it
+        leaves NotesDB alone and only writes to s. Gives up as soon as a
+        newer search has been started.
+
+        @return: (filtered notes, {key: (content, lowercased content)} of
+        the contents that were lowercased), or None if it gave up.
+        """
+
+        filtered_notes = []
+        folded = {}
+        for i, e in enumerate(s.entries):
+            if s.generation is not None and not i % SEARCH_CHECK_INTERVAL and \
+                    s.generation != self.search_generation:
+                return None
+
+            if s.regexp:
+                tagfound = self.helper_match_regexp(s, e)
+
+            else:
+                tagfound = self.helper_match_gstyle(s, e, folded)
+
+            if tagfound is not None:
+                # we have to store our local key also
+                filtered_notes.append(utils.KeyValueObject(key=e[0], note=e[1], tagfound=tagfound))
+
+        # keys on the typed fields, comparison functions would look them
+        # up again for every comparison.
+        if s.sort_mode == 0:
+            if s.pinned_ontop == 0:
                 # sort alphabetically on title
                 filtered_notes.sort(key=lambda o: utils.get_note_title(o.note))
             else:
-                filtered_notes.sort(utils.sort_by_title_pinned)
+                filtered_notes.sort(key=lambda o: (not o.note.pinned, utils.get_note_title(o.note)))
 
         else:
-            if self.config.pinned_ontop == 0:
+            if s.pinned_ontop == 0:
                 # last modified on top
-                filtered_notes.sort(key=lambda o: -float(o.note.get('modifydate', 0)))
+                filtered_notes.sort(key=lambda o: -o.note.modifydate)
             else:
-                filtered_notes.sort(utils.sort_by_modify_date_pinned, reverse=True)
+                filtered_notes.sort(key=lambda o: (o.note.pinned, o.note.modifydate), reverse=True)
 
-        return filtered_notes, match_regexp, active_notes
+        return filtered_notes, folded
 
-    def _helper_gstyle_tagmatch(self, tag_pats, note):
-        if tag_pats:
-            tags = note.get('tags')
+    def helper_search_done(self, s, r):
+        """Take in the result r of helper_search() for search s, on the
+        main thread.
+
+        @return: what filter_notes() returns.
+        """
+
+        filtered_notes, folded = r
+        if s.generation is not None:
+            # notes that were purged while the worker was searching
+            filtered_notes = [o for o in filtered_notes if o.key in self.notes]
+
+        # keep what the search lowercased for the next one
+        for k, (c, f) in folded.iteritems():
+            n = self.notes.get(k)
+            if n is not None:
+                n.set_folded(c, f)
+
+        if s.query is not None:
+            self.helper_remember_search(s.query, set(o.key for o in filtered_notes) | s.changed)
+
+        self.cold_decompressions += s.decompressions
+        if self.search_running is s:
+            self.search_running = None
+
+        return filtered_notes, s.match_regexp, s.active_notes
+
+    def helper_snapshot_content(self, s, e):
+        """Return the full content of snapshot entry e of search s.
+        """
 
+        k, evicted = e[0], e[4]
+        if evicted is None:
+            return e[2] or u''
+
+        if evicted is True:
+            try:
+                return self.store.load_content(k) or u''
+
+            except ReadError:
+                # purged since the snapshot was taken
+                return u''
+
+        # not helper_decompress_cold(), the worker keeps to s
+        s.decompressions += 1
+        return zlib.decompress(evicted).decode('utf-8')
+
+    def _helper_gstyle_tagmatch(self, tag_pats, tags):
+        if tag_pats:
             # tag: patterns specified, but note has no tags, so no match
             if not tags:
                 return 0
@@ -285,207 +1002,732 @@ class NotesDB(utils.SubjectMixin):
             # we found the first p that does not occur in content
             return False
 
-    def filter_notes_gstyle(self, search_string=None):
+    def helper_match_gstyle(self, s, e, folded):
+        """Return tagfound if snapshot entry e matches gstyle search s,
+        None if it does not.
 
-        filtered_notes = []
-        # total number of notes, excluding deleted
-        active_notes = 0
+        Contents lowercased for a case insensitive search are added to
+        folded.
+        """
 
-        if not search_string:
-            for k in self.notes:
-                n = self.notes[k]
-                if not n.get('deleted'):
-                    active_notes += 1
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+        tagmatch = self._helper_gstyle_tagmatch(s.tag_pats, e[5])
+        if not tagmatch:
+            return None
 
-            return filtered_notes, [], active_notes
+        if s.word_pats:
+            c = self.helper_snapshot_content(s, e)
+            if not s.case_sensitive:
+                if e[3] is not None:
+                    c = e[3]
 
-        # group0: ag - not used
-        # group1: t(ag)?:([^\s]+)
-        # group2: multiple words in quotes
-        # group3: single words
-        # example result for 't:tag1 t:tag2 word1 "word2 word3" tag:tag3' ==
-        # [('', 'tag1', '', ''), ('', 'tag2', '', ''), ('', '', '', 'word1'), ('', '', 'word2 word3', ''), ('ag', 'tag3', '', '')]
+                else:
+                    c = c.lower()
+                    if e[4] is None:
+                        # lowercased once per content, not once per search
+                        folded[e[0]] = (e[2], c)
 
-        groups = re.findall('t(ag)?:([^\s]+)|"([^"]+)"|([^\s]+)', search_string)
-        tms_pats = [[] for _ in range(3)]
+            if not self._helper_gstyle_mswordmatch(s.word_pats, c):
+                return None
 
-        # we end up with [[tag_pats],[multi_word_pats],[single_word_pats]]
-        for gi in groups:
-            for mi in range(1, 4):
-                if gi[mi]:
-                    tms_pats[mi - 1].append(gi[mi])
+        # tagmatch == 1 if a tag was specced and found
+        # tagmatch == 2 if no tag was specced (so all notes go through)
+        return 1 if tagmatch == 1 else 0
 
-        for k in self.notes:
-            n = self.notes[k]
+    def helper_match_regexp(self, s, e):
+        """Return tagfound if snapshot entry e matches regexp search s,
+        None if it does not.
+        """
 
-            if not n.get('deleted'):
-                active_notes += 1
-                c = n.get('content')
+        if not s.sspat:
+            return 0
 
-                # case insensitive mode: WARNING - SLOW!
-                if not self.config.case_sensitive and c:
-                    c = c.lower()
+        t = e[5]
+        if s.search_tags == 1 and t:
+            # this used to use a filter(), but that would by definition
+            # test all elements, whereas we can stop when the first
+            # matching element is found
+            # now I'm using this awesome trick by Alex Martelli on
+            # http://stackoverflow.com/a/2748753/532513
+            # first parameter of next is a generator
+            # next() executes one step, but due to the if, this will
+            # either be first matching element or None (second param)
+            if next((ti for ti in t if s.sspat.search(ti)), None) is not None:
+                return 1
 
-                tagmatch = self._helper_gstyle_tagmatch(tms_pats[0], n)
-                # case insensitive mode: WARNING - SLOW!
-                msword_pats = tms_pats[1] + tms_pats[2] if self.config.case_sensitive else [p.lower() for p in tms_pats[1] + tms_pats[2]]
-                if tagmatch and self._helper_gstyle_mswordmatch(msword_pats, c):
-                    # we have a note that can go through!
+        # a content that cannot match is not even read
+        if e[6] and s.sspat.search(self.helper_snapshot_content(s, e)):
+            return 0
 
-                    # tagmatch == 1 if a tag was specced and found
-                    # tagmatch == 2 if no tag was specced (so all notes go through)
-                    tagfound = 1 if tagmatch == 1 else 0
-                    # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=tagfound))
+        return None
 
-        return filtered_notes, '|'.join(tms_pats[1] + tms_pats[2]), active_notes
+    def helper_refine_candidates(self, query):
+        """Return the keys of the notes that can match gstyle query, or
+        None if all notes have to be searched.
 
-    def filter_notes_regexp(self, search_string=None):
-        """Return list of notes filtered with search_string,
-        a regular expression, each a tuple with (local_key, note).
+        query is (case sensitive, tag patterns, word patterns) with the
+        words lowercased in case insensitive mode. It refines an earlier
+        query if every tag pattern of that one is the start of one of its
+        tag patterns, and every word is part of one of its words: nothing
+        that did not match the earlier query can match it then. The
+        earlier query with the fewest matches is used.
         """
 
-        if search_string:
-            try:
-                if self.config.case_sensitive == 0:
-                    sspat = re.compile(search_string, re.I)
-                else:
-                    sspat = re.compile(search_string)
-            except re.error:
-                sspat = None
+        cs, tag_pats, word_pats = query
+        best = None
+        for q, keys in self.search_cache:
+            if q[0] != cs or (best is not None and len(keys) >= len(best)):
+                continue
 
-        else:
-            sspat = None
+            if all(any(tp.startswith(t) for tp in tag_pats) for t in q[1]) and \
+                    all(any(w in wp for wp in word_pats) for w in q[2]):
+                best = keys
 
-        filtered_notes = []
-        # total number of notes, excluding deleted ones
-        active_notes = 0
-        for k in self.notes:
-            n = self.notes[k]
-            # we don't do anything with deleted notes (yet)
-            if n.get('deleted'):
-                continue
+        return None if best is None else set(best)
 
-            active_notes += 1
-
-            c = n.get('content')
-            if self.config.search_tags == 1:
-                t = n.get('tags')
-                if sspat:
-                    # this used to use a filter(), but that would by definition
-                    # test all elements, whereas we can stop when the first
-                    # matching element is found
-                    # now I'm using this awesome trick by Alex Martelli on
-                    # http://stackoverflow.com/a/2748753/532513
-                    # first parameter of next is a generator
-                    # next() executes one step, but due to the if, this will
-                    # either be first matching element or None (second param)
-                    if t and next((ti for ti in t if sspat.search(ti)), None) is not None:
-                        # we have to store our local key also
-                        filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=1))
-
-                    elif sspat.search(c):
-                        # we have to store our local key also
-                        filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+    def helper_remember_search(self, query, keys):
+        self.search_cache = [e for e in self.search_cache if e[0] != query]
+        self.search_cache.append([query, keys])
+        del self.search_cache[:-SEARCH_CACHE_SIZE]
 
-                else:
-                    # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
-            else:
-                if (not sspat or sspat.search(c)):
-                    # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+    def helper_search_changed(self, k):
+        """Note k changed, it might match earlier searches now.
+        """
 
-        match_regexp = search_string if sspat else ''
+        for q, keys in self.search_cache:
+            keys.add(k)
 
-        return filtered_notes, match_regexp, active_notes
+        if self.search_running is not None:
+            # it is remembered when it is done
+            self.search_running.changed.add(k)
 
     def get_note(self, key):
+        self.helper_fault_content(key)
         return self.notes[key]
 
     def get_note_content(self, key):
+        self.helper_fault_content(key)
         return self.notes[key].get('content')
 
     def get_note_status(self, key):
-        n = self.notes[key]
+        n = self.helper_get_note(key)
         o = utils.KeyValueObject(saved=False, synced=False, modified=False)
-        modifydate = float(n['modifydate'])
-        savedate = float(n['savedate'])
+        modifydate = n.modifydate
 
-        if savedate > modifydate:
+        if n.savedate > modifydate:
             o.saved = True
         else:
             o.modified = True
 
-        if float(n['syncdate']) > modifydate:
+        if (n.syncdate or 0) > modifydate:
             o.synced = True
 
         return o
 
+    def get_note_revisions(self, key):
+        """Return [(revision, modifydate)] of the saved versions of note key,
+        most recent first.
+        """
+
+        if self.history is None:
+            return []
+
+        return self.history.revisions(key)[::-1]
+
+    def restore_note_revision(self, key, revision):
+        """Bring back the content and tags of an earlier version of note key.
+
+        This is a change like any other, it is saved as a new revision and
+        can be undone by restoring the revision before it.
+
+        @raise KeyError: if note key has no such revision, which without a
+        history it never has.
+        """
+
+        if self.history is None:
+            raise KeyError(revision)
+
+        content, tags = self.history.get(key, revision)
+        self.set_note_content(key, content)
+        self.set_note_tags(key, u','.join(tags))
+
+    def get_cold_content_stats(self):
+        """Return how much memory compressing cold contents saves.
+
+        The returned object has notes and raw_size / size, the number of
+        compressed contents and their size in characters before and in
+        bytes after compression. Of the accesses to note contents through
+        get_note() and friends, decompressions needed to decompress a
+        content, searches included.
+        """
+
+        return utils.KeyValueObject(notes=len(self.cold_content),
+                                    raw_size=self.cold_raw_size,
+                                    size=self.cold_size,
+                                    accesses=self.content_accesses,
+                                    decompressions=self.cold_decompressions)
+
+    def get_tags(self):
+        """Return the list of distinct tags of the live notes.
+
+        The same list is returned for as long as the set of tags does not
+        change, so callers can tell by its identity.
+        """
+
+        if self.tag_list is None:
+            self.tag_list = self.tag_table.keys()
+
+        return self.tag_list
+
     def get_save_queue_len(self):
         return self.q_save.qsize()
 
     def get_sync_queue_len(self):
         return self.q_sync.qsize()
 
-    def helper_key_to_fname(self, k):
-            return os.path.join(self.db_path, k) + '.json'
+    def helper_get_note(self, k):
+        """Return live or deleted note k, or None if it has been purged.
+        """
+
+        n = self.notes.get(k)
+        if n is None:
+            n = self.tombstones.get(k)
+
+        return n
+
+    def helper_bury(self, k):
+        """Move deleted note k from the live notes to the tombstones.
+        """
+
+        # the server still needs the content, and tombstones are neither
+        # evicted nor compressed.
+        if k in self.cold_content:
+            self.notes[k].content = self.helper_drop_cold(k)
+
+        n = self.notes.pop(k)
+        self.helper_remove_tags(n)
+        self.helper_index_remove(k)
+        if k in self.lazy_keys:
+            n.content = self.store.load_content(k)
+            self.lazy_keys.discard(k)
+
+        self.content_cache_size -= self.content_cache.pop(k, 0)
+        self.content_used.pop(k, None)
+        self.tombstones[k] = n
+
+    def helper_purge(self, k):
+        """Forget deleted note k, the save worker removes it from disc.
+        """
+
+        n = self.notes.pop(k, None)
+        if n is not None:
+            self.helper_remove_tags(n)
+            self.helper_index_remove(k)
+            self.lazy_keys.discard(k)
+            self.content_cache_size -= self.content_cache.pop(k, 0)
+            self.content_used.pop(k, None)
+            if k in self.cold_content:
+                self.helper_drop_cold(k)
+
+        self.tombstones.pop(k, None)
+        self.dirty_save.discard(k)
+        self.dirty_sync.discard(k)
+
+        o = utils.KeyValueObject(action=ACTION_PURGE, key=k, note=None)
+        if k not in self.q_save.put_batch([o]):
+            self.saves_in_flight[k] = self.saves_in_flight.get(k, 0) + 1
+
+    def helper_add_tags(self, n):
+        """Count the tags of note n, which just became live, and replace
+        them by the interned ones.
+        """
+
+        if not n.tags:
+            return
+
+        tags = []
+        for t in n.tags:
+            entry = self.tag_table.get(t)
+            if entry is None:
+                entry = self.tag_table[t] = [t, 0]
+                self.tag_list = None
+
+            entry[1] += 1
+            tags.append(entry[0])
+
+        n.tags = tuple(tags)
+
+    def helper_remove_tags(self, n):
+        """Note n is no longer live, or is about to get other tags.
+        """
+
+        for t in n.tags or ():
+            entry = self.tag_table[t]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.tag_table[t]
+                self.tag_list = None
+
+    def helper_update_note(self, k, n, d):
+        """n.update(d) for live note n with key k, keeping the tag table
+        and search index up to date.
+        """
+
+        self.helper_remove_tags(n)
+        n.update(d)
+        self.helper_add_tags(n)
+        if 'content' in d:
+            # not a stub anymore
+            self.lazy_keys.discard(k)
+            self.helper_index_changed(k)
+
+        elif 'tags' in d:
+            self.helper_search_changed(k)
+
+    def helper_get_search_index(self, fold=None):
+        """Return the trigram index for case mode fold, by default the
+        current one.
+
+        A new index starts out with all notes pending.
+        """
+
+        if fold is None:
+            fold = not self.config.case_sensitive
+
+        idx = self.search_indexes.get(fold)
+        if idx is None:
+            idx = self.search_indexes[fold] = search_index.TrigramIndex(fold)
+            idx.add_pending(self.notes)
+
+        return idx
+
+    def helper_index_changed(self, k):
+        """The content of note k changed, index it again later.
+        """
+
+        self.helper_search_changed(k)
+        for idx in self.search_indexes.itervalues():
+            # until then it is always a candidate, its old trigrams can
+            # only add candidates that are checked anyway.
+            idx.add_pending((k,))
+
+    def helper_index_remove(self, k):
+        for idx in self.search_indexes.itervalues():
+            idx.remove(k)
+
+    def update_search_index(self, budget=0.1):
+        """Index pending notes for at most budget seconds.
+
+        Called by housekeeping, so that a large database gets indexed bit by
+        bit without blocking the UI, and edits are indexed as they come in.
+        """
+
+        end = time.time() + budget
+        for idx in self.search_indexes.itervalues():
+            while idx.pending and time.time() < end:
+                k = idx.pending.pop()
+                n = self.notes.get(k)
+                if n is not None:
+                    idx.set(k, self.helper_search_content(k, n))
+
+    def helper_purge_synced(self, k):
+        """Purge note k if the server has it as deleted.
+
+        That is the case when the server sent it back deleted, and nothing
+        was changed here since. A live note has been deleted by another
+        client, observers are told so that they can drop it.
+
+        @returns: True if the note was purged.
+        """
+
+        n = self.helper_get_note(k)
+        if not n.deleted or n.modifydate > (n.syncdate or 0):
+            return False
+
+        live = k in self.notes
+        self.helper_purge(k)
+        if live:
+            self.notify_observers('deleted:note', utils.KeyValueObject(lkey=k))
+
+        return True
+
+    def helper_cache_content(self, k):
+        """Record that note k has its full content in memory and was just used.
+        """
+
+        if self.cold_after:
+            # the content might just have been replaced, by a sync.
+            if k in self.cold_content:
+                self.helper_drop_cold(k)
+
+            self.content_used.pop(k, None)
+            self.content_used[k] = time.time()
+
+        if not self.config.lazy_content:
+            return
+
+        c = self.notes[k].get('content') or ''
+        self.content_cache_size += len(c) - self.content_cache.pop(k, 0)
+        self.content_cache[k] = len(c)
+        self.lazy_keys.discard(k)
+
+    def helper_evict_content(self, keep=None):
+        """Replace least recently used contents by stubs until within budget.
+
+        Only notes that have been written to disc in their current form can
+        be evicted, their content has to come back from the store. Note keep
+        is being used and stays, even if it is bigger than the budget.
+        """
+
+        if self.content_cache_size <= self.content_cache_budget:
+            return
+
+        for k in self.content_cache.keys():
+            if self.content_cache_size <= self.content_cache_budget:
+                break
+
+            if k == keep:
+                continue
+
+            n = self.notes.get(k)
+            if n is not None:
+                if not self.helper_note_saved(k) or \
+                   (self.config.simplenote_sync and k in self.threaded_syncing_keys):
+                    continue
+
+                c = n.get('content') or ''
+                stub = self.helper_content_stub(c)
+                n['content'] = stub
+                if len(stub) < len(c):
+                    self.lazy_keys.add(k)
+
+            self.content_cache_size -= self.content_cache.pop(k)
+
+    def helper_compress_cold(self):
+        """Compress the contents of notes that were not used for a while.
+
+        Like with eviction, only notes that have been written to disc in
+        their current form qualify: the save and sync workers get copies of
+        the note, and these must have the full content.
+        """
+
+        if not self.cold_after:
+            return
+
+        # content_used is in order of use, so the cold ones are up front.
+        # only those are looked at, not every note with its content in
+        # memory.
+        cold = time.time() - self.cold_after
+        due = []
+        for k, used in self.content_used.iteritems():
+            if used > cold:
+                break
+
+            due.append(k)
+
+        for k in due:
+            n = self.notes.get(k)
+            if n is None:
+                # there is no live note with this key anymore
+                del self.content_used[k]
+                continue
+
+            if not self.helper_note_saved(k) or \
+               (self.config.simplenote_sync and k in self.threaded_syncing_keys):
+                continue
+
+            del self.content_used[k]
+            c = n.content or u''
+            stub = self.helper_content_stub(c)
+            if len(stub) < len(c):
+                data = zlib.compress(c.encode('utf-8'))
+                self.cold_content[k] = (data, len(c))
+                self.cold_raw_size += len(c)
+                self.cold_size += len(data)
+                n.content = stub
+
+    def helper_drop_cold(self, k):
+        """Forget the compressed content of note k.
+
+        @returns: the content.
+        """
+
+        data, length = self.cold_content.pop(k)
+        self.cold_raw_size -= length
+        self.cold_size -= len(data)
+        return self.helper_decompress_cold(data)
+
+    def helper_decompress_cold(self, data):
+        self.cold_decompressions += 1
+        return zlib.decompress(data).decode('utf-8')
+
+    def helper_content_stub(self, c):
+        """Return the title line of content c and a snippet of what follows.
+        """
+
+        start = len(c) - len(c.lstrip())
+        end = c.find('\n', start)
+        if end < 0:
+            return c
+
+        return c[:end + 1 + CONTENT_STUB_LENGTH]
+
+    def helper_fault_content(self, k):
+        """Make sure that note k has its full content in memory.
+        """
+
+        self.content_accesses += 1
+        if k in self.lazy_keys:
+            self.notes[k]['content'] = self.store.load_content(k)
+            self.helper_cache_content(k)
+            self.helper_evict_content(keep=k)
+
+        elif k in self.cold_content:
+            self.notes[k].content = self.helper_drop_cold(k)
+            self.helper_cache_content(k)
+
+        elif k in self.content_cache or k in self.content_used:
+            self.helper_cache_content(k)
+
+    def helper_search_content(self, k, n):
+        """Return the full content of note n for searching.
+
+        Evicted contents are read from the store, without pushing the notes
+        we're working with out of the cache.
+        """
+
+        if k in self.lazy_keys:
+            return self.store.load_content(k)
+
+        if k in self.cold_content:
+            return self.helper_decompress_cold(self.cold_content[k][0])
+
+        return n.get('content')
+
+    def helper_note_changed(self, k):
+        """Note k was changed locally, so it has to be saved and synced.
+        """
+
+        self.dirty_save.add(k)
+        self.dirty_sync.add(k)
+
+    def helper_note_saved(self, k):
+        """True if note k has been written to disc in its current form.
+        """
+
+        if k in self.dirty_save or self.saves_in_flight.get(k):
+            return False
+
+        n = self.helper_get_note(k)
+        return n.modifydate <= n.savedate and (n.syncdate or 0) <= n.savedate
+
+    def helper_content_hash(self, note):
+        c = note.content or ''
+        if isinstance(c, unicode):
+            c = c.encode('utf-8')
+
+        return hashlib.md5(c).hexdigest()
+
+    def helper_meta_hash(self, d):
+        # savedate changes with every save, it does not need writing.
+        meta = dict((f, v) for f, v in d.items() if f not in ('content', 'savedate'))
+        return hashlib.md5(json.dumps(meta, sort_keys=True)).hexdigest()
 
     def helper_save_note(self, k, note):
         """Save a single note to disc.
 
+        The text mirror is only rewritten when the content or the title
+        changed, and a note of which only the metadata changed (for example
+        the syncdate after a sync) is handed to the cheaper save_meta() of
+        the store.
         """
 
+        # the stores get the note in the simplenote format
+        d = note.to_dict()
+        old_chash, old_mhash = self.save_hashes.get(k, (None, None))
+        chash = self.helper_content_hash(note)
+        mhash = self.helper_meta_hash(d)
+
         if self.config.notes_as_txt:
-            t = utils.get_note_title_file(note)
-            if t and not note.get('deleted'):
-                if k in self.titlelist:
-                    logging.debug('Writing note : %s %s' % (t, self.titlelist[k]))
-                    if self.titlelist[k] != t:
-                        dfn = os.path.join(self.config.txt_path, self.titlelist[k])
-                        if os.path.isfile(dfn):
-                            logging.debug('Delete file %s ' % (dfn, ))
-                            os.unlink(dfn)
-                        else:
-                            logging.debug('File not exits %s ' % (dfn, ))
+            with self.txt_lock:
+                self.helper_save_txt(k, note, chash, old_chash)
+
+        if not self.config.simplenote_sync and note.deleted:
+            self.store.delete(k)
+            self.save_hashes.pop(k, None)
+
+        elif chash != old_chash or old_mhash is None:
+            self.store.save(k, d)
+            self.save_hashes[k] = (chash, mhash)
+            if self.history is not None and chash != old_chash:
+                self.history.add(k, note.content, note.tags, note.modifydate)
+
+        elif mhash != old_mhash:
+            self.store.save_meta(k, d)
+            self.save_hashes[k] = (chash, mhash)
+
+        # record that we saved this to disc.
+        note.savedate = time.time()
+
+    def helper_purge_note(self, k):
+        """Remove note k and its text mirror file from disc.
+
+        Runs in the save worker.
+        """
+
+        if self.config.notes_as_txt:
+            with self.txt_lock:
+                t = self.titles.name(k)
+                # the file could have gone to another note in the meantime
+                if t is not None and self.titles.key(t) == k:
+                    self.helper_unlink_txt(t)
+
+                self.titles.remove(k)
+
+        self.store.delete(k)
+        self.save_hashes.pop(k, None)
+        if self.history is not None:
+            self.history.delete(k)
+
+    def helper_save_txt(self, k, note, chash, old_chash):
+        """Bring the text mirror file of note k up to date.
+
+        Runs in the save worker, with self.txt_lock held.
+        """
+
+        old = self.titles.name(k)
+        base = utils.get_note_title_file(note)
+        if base and not note.deleted:
+            t = self.titles.choose(k, base)
+            if old is not None and old != t:
+                # the title changed
+                self.helper_unlink_txt(old)
+
+            if old != t or chash != old_chash:
+                logging.debug('Writing note : %s %s' % (t, old))
+                self.helper_write_txt(k, t, note)
+                self.titles.set(k, t)
+
+        elif base and note.deleted and old is not None:
+            self.helper_unlink_txt(old)
+            self.titles.remove(k)
+
+    def helper_unlink_txt(self, t):
+        dfn = os.path.join(self.config.txt_path, t)
+        if os.path.isfile(dfn):
+            logging.debug('Delete file %s ' % (dfn, ))
+            os.unlink(dfn)
+        else:
+            logging.debug('File not exits %s ' % (dfn, ))
+
+        self.txt_stats.remove(t)
+
+    def helper_read_txt(self, t):
+        """Return the content of text mirror file t.
+        """
+
+        fn = os.path.join(self.config.txt_path, t)
+        try:
+            with codecs.open(fn, mode='rb', encoding='utf-8') as f:
+                return f.read()
+
+        except IOError, e:
+            logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
+            raise ReadError('Error opening note file')
+
+        except ValueError, e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
+            raise ReadError('Error reading note file')
+
+    def helper_import_txt(self, t, c):
+        """Create a new note from text file t with content c.
+
+        The file itself is removed, the note is written back to the text
+        mirror under the name that goes with its title.
+        """
+
+        nk = self.create_note(c)
+        nn = os.path.splitext(t)[0]
+        if nn != utils.get_note_title(self.notes[nk]):
+            self.notes[nk]['content'] = nn + "\n\n" + c
+            self.helper_cache_content(nk)
+
+        os.unlink(os.path.join(self.config.txt_path, t))
+        return nk
+
+    def helper_write_txt(self, k, t, note):
+        """Write the content of note k to the text mirror file t.
+        """
+
+        fn = os.path.join(self.config.txt_path, t)
+        try:
+            with codecs.open(fn, mode='wb', encoding='utf-8') as f:
+                c = note.get('content')
+                if isinstance(c, str):
+                    c = unicode(c, 'utf-8')
                 else:
-                    logging.debug('Key not in list %s ' % (k, ))
+                    c = unicode(c)
+
+                f.write(c)
+
+            self.txt_stats.record(t, txt_mirror.stat_key(os.stat(fn)), k)
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
+            raise WriteError('Error opening note file')
+
+        except ValueError, e:
+            logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
+            raise WriteError('Error writing note file')
+
+    def helper_snapshot_note(self, n):
+        """Return an independent copy of note n, for the worker threads.
+
+        Fields of a note are only ever replaced, never changed in place: the
+        content string is immutable anyway, tags and systemtags are tuples
+        and only the extra dictionary is copied. A shallow copy is therefore
+        a complete version of the note that shares all its values with the
+        original, at the cost of copying a dozen references instead of the
+        content.
+        """
+
+        return n.copy()
+
+    def helper_write_snapshot(self, threaded=True):
+        """Write a startup snapshot of all notes that are in sync with the disc.
+
+        Notes and their file stats are copied here on the main thread, so
+        that they are guaranteed to match. Pickling and writing can then
+        happen in a background thread.
+        """
+
+        if not self.store.snapshot:
+            return
+
+        notes = {}
+        for k, n in self.notes.items() + self.tombstones.items():
+            # stubs of evicted contents are simply parsed again at startup.
+            if k not in self.lazy_keys and k not in self.cold_content and \
+               self.helper_note_saved(k):
+                notes[k] = n.to_dict()
+
+        stats = self.store.stats.copy()
+
+        if threaded:
+            thread_snapshot = Thread(target=self.store.write_snapshot, args=(notes, stats))
+            thread_snapshot.setDaemon(True)
+            thread_snapshot.start()
 
-                self.titlelist[k] = t
-                fn = os.path.join(self.config.txt_path, t)
-                try:
-                    with codecs.open(fn, mode='wb', encoding='utf-8') as f:
-                        c = note.get('content')
-                        if isinstance(c, str):
-                            c = unicode(c, 'utf-8')
-                        else:
-                            c = unicode(c)
-
-                        f.write(c)
-                except IOError, e:
-                    logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
-                    raise WriteError('Error opening note file')
-
-                except ValueError, e:
-                    logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
-                    raise WriteError('Error writing note file')
-
-            elif t and note.get('deleted') and k in self.titlelist:
-                dfn = os.path.join(self.config.txt_path, self.titlelist[k])
-                if os.path.isfile(dfn):
-                    logging.debug('Delete file %s ' % (dfn, ))
-                    os.unlink(dfn)
-
-        fn = self.helper_key_to_fname(k)
-        if not self.config.simplenote_sync and note.get('deleted'):
-            if os.path.isfile(fn):
-                os.unlink(fn)
         else:
-            json.dump(note, open(fn, 'wb'), indent=2)
+            self.store.write_snapshot(notes, stats)
 
-        # record that we saved this to disc.
-        note['savedate'] = time.time()
+    def close(self):
+        """Called when nvPY exits, after the last save_threaded().
+        """
+
+        self.helper_write_snapshot(threaded=False)
+        self.store.close()
+        if self.config.notes_as_txt:
+            self.txt_stats.save()
 
     def sync_note_unthreaded(self, k):
         """Sync a single note with the server.
@@ -494,12 +1736,13 @@ class NotesDB(utils.SubjectMixin):
         This is a sychronous (blocking) call.
         """
 
+        self.helper_fault_content(k)
         note = self.notes[k]
 
-        if not note.get('key') or float(note.get('modifydate')) > float(note.get('syncdate')):
+        if not note.key or note.modifydate > (note.syncdate or 0):
             # if has no key, or it has been modified sync last sync,
             # update to server
-            uret = self.simplenote.update_note(note)
+            uret = self.simplenote.update_note(note.to_dict())
 
             if uret[1] == 0:
                 # success!
@@ -517,7 +1760,12 @@ class NotesDB(utils.SubjectMixin):
                 n['syncdate'] = now
 
                 # update our existing note in-place!
-                note.update(n)
+                self.helper_update_note(k, note, n)
+                if self.helper_purge_synced(k):
+                    return (k, False)
+
+                self.helper_cache_content(k)
+                self.dirty_save.add(k)
 
                 # return the key
                 return (k, new_content)
@@ -532,9 +1780,14 @@ class NotesDB(utils.SubjectMixin):
             if gret[1] == 0:
                 n = gret[0]
 
-                if int(n.get('syncnum')) > int(note.get('syncnum')):
+                if int(n.get('syncnum')) > note.syncnum:
                     n['syncdate'] = time.time()
-                    note.update(n)
+                    self.helper_update_note(k, note, n)
+                    if self.helper_purge_synced(k):
+                        return (k, False)
+
+                    self.helper_cache_content(k)
+                    self.dirty_save.add(k)
                     return (k, True)
 
                 else:
@@ -544,14 +1797,27 @@ class NotesDB(utils.SubjectMixin):
                 return None
 
     def save_threaded(self):
-        for k, n in self.notes.items():
-            savedate = float(n.get('savedate'))
-            if float(n.get('modifydate')) > savedate or \
-               float(n.get('syncdate')) > savedate:
-                cn = copy.deepcopy(n)
+        # everything we find is handed to the save worker in one batch
+        batch = []
+        # only notes that were changed locally or by a sync can need saving
+        for k in self.dirty_save:
+            n = self.helper_get_note(k)
+            if n is None:
+                # purged in the meantime
+                continue
+
+            if n.modifydate > n.savedate or (n.syncdate or 0) > n.savedate:
+                cn = self.helper_snapshot_note(n)
                 # put it on my queue as a save
-                o = utils.KeyValueObject(action=ACTION_SAVE, key=k, note=cn)
-                self.q_save.put(o)
+                batch.append(utils.KeyValueObject(action=ACTION_SAVE, key=k, note=cn))
+
+        self.dirty_save.clear()
+
+        replaced = self.q_save.put_batch(batch)
+        for o in batch:
+            # a copy that replaced an unwritten one takes over its place
+            if o.key not in replaced:
+                self.saves_in_flight[o.key] = self.saves_in_flight.get(o.key, 0) + 1
 
         # in this same call, we process stuff that might have been put on the result queue
         nsaved = 0
@@ -566,10 +1832,32 @@ class NotesDB(utils.SubjectMixin):
             else:
                 # o (.action, .key, .note) is something that was written to disk
                 # we only record the savedate.
-                self.notes[o.key]['savedate'] = o.note['savedate']
+                self.saves_in_flight[o.key] -= 1
+                if not self.saves_in_flight[o.key]:
+                    del self.saves_in_flight[o.key]
+
+                n = self.helper_get_note(o.key)
+                if n is None:
+                    # purged, possibly by this very action
+                    continue
+
+                n.savedate = o.note.savedate
                 self.notify_observers('change:note-status', utils.KeyValueObject(what='savedate', key=o.key))
                 nsaved += 1
 
+        # once a burst of saves has been written out completely, we refresh
+        # the startup snapshot in the background.
+        if nsaved:
+            self.snapshot_outdated = True
+            # saved notes can be evicted again
+            self.helper_evict_content()
+
+        elif self.snapshot_outdated and not self.q_save.qsize():
+            self.snapshot_outdated = False
+            self.helper_write_snapshot()
+
+        self.helper_compress_cold()
+
         return nsaved
 
     def sync_to_server_threaded(self, wait_for_idle=True):
@@ -593,22 +1881,34 @@ class NotesDB(utils.SubjectMixin):
             lastmod = 0
 
         now = time.time()
-        for k, n in self.notes.items():
+        # only notes that were changed locally since their last sync can need syncing
+        for k in list(self.dirty_sync):
+            n = self.helper_get_note(k)
+            if n is None:
+                # purged by a full sync in the meantime
+                self.dirty_sync.discard(k)
+                continue
+
             # if note has been modified sinc the sync, we need to sync.
             # only do so if note hasn't been touched for 3 seconds
             # and if this note isn't still in the queue to be processed by the
             # worker (this last one very important)
-            modifydate = float(n.get('modifydate', -1))
-            syncdate = float(n.get('syncdate', -1))
-            if modifydate > syncdate and \
-               now - modifydate > lastmod and \
-               k not in self.threaded_syncing_keys:
+            modifydate = n.modifydate
+            if modifydate <= (n.syncdate or 0):
+                self.dirty_sync.discard(k)
+
+            elif now - modifydate > lastmod and \
+                 k not in self.threaded_syncing_keys:
+                # the result will put it back if it has to be synced again
+                self.dirty_sync.discard(k)
                 # record that we've requested a sync on this note,
                 # so that we don't keep on putting stuff on the queue.
                 self.threaded_syncing_keys[k] = True
-                cn = copy.deepcopy(n)
+                # the server needs the full content
+                self.helper_fault_content(k)
+                cn = self.helper_snapshot_note(n)
                 # we store the timestamp when this copy was made as the syncdate
-                cn['syncdate'] = time.time()
+                cn.syncdate = time.time()
                 # put it on my queue as a sync
                 o = utils.KeyValueObject(action=ACTION_SYNC_PARTIAL_TO_SERVER, key=k, note=cn)
                 self.q_sync.put(o)
@@ -626,25 +1926,40 @@ class NotesDB(utils.SubjectMixin):
 
             else:
                 okey = o.key
+                n = self.helper_get_note(okey)
+
+                if n is None:
+                    # purged by a full sync in the meantime
+                    del self.threaded_syncing_keys[okey]
+                    continue
 
                 if o.error:
                     nerrored += 1
 
                 else:
-                    # o (.action, .key, .note) is something that was synced
+                    # o (.action, .key, .note) is something that was synced,
+                    # o.note is the dict that came back from the server.
 
                     # we only apply the changes if the syncdate is newer than
                     # what we already have, since the main thread could be
                     # running a full sync whilst the worker thread is putting
                     # results in the queue.
-                    if float(o.note['syncdate']) > float(self.notes[okey]['syncdate']):
+                    syncdate = float(o.note['syncdate'])
+                    if syncdate > (n.syncdate or 0):
 
-                        if float(o.note['syncdate']) > float(self.notes[okey]['modifydate']):
+                        if syncdate > n.modifydate:
                             # note was synced AFTER the last modification to our local version
                             # do an in-place update of the existing note
                             # this could be with or without new content.
-                            old_note = copy.deepcopy(self.notes[okey])
-                            self.notes[okey].update(o.note)
+                            old_note = self.helper_snapshot_note(n)
+                            if okey in self.notes:
+                                self.helper_update_note(okey, n, o.note)
+                                if 'content' in o.note:
+                                    self.helper_cache_content(okey)
+
+                            else:
+                                n.update(o.note)
+
                             # notify anyone (probably nvPY) that this note has been changed
                             self.notify_observers('synced:note', utils.KeyValueObject(lkey=okey, old_note=old_note))
 
@@ -660,8 +1975,10 @@ class NotesDB(utils.SubjectMixin):
                             # notes.
                             tkeys = ['syncnum', 'version', 'syncdate', 'key']
                             for tk in tkeys:
-                                self.notes[okey][tk] = o.note[tk]
+                                n[tk] = o.note[tk]
 
+                        # the new syncdate has to be saved
+                        self.dirty_save.add(okey)
                         nsynced += 1
                         self.notify_observers('change:note-status', utils.KeyValueObject(what='syncdate', key=okey))
 
@@ -669,6 +1986,14 @@ class NotesDB(utils.SubjectMixin):
                 # we can take it from this blocker dict
                 del self.threaded_syncing_keys[okey]
 
+                if self.helper_purge_synced(okey):
+                    # the server has the deletion, nothing left to do
+                    continue
+
+                if n.modifydate > (n.syncdate or 0):
+                    # sync failed, or the user changed the note in the meantime
+                    self.dirty_sync.add(okey)
+
         return (nsynced, nerrored)
 
     def sync_full(self):
@@ -685,26 +2010,61 @@ class NotesDB(utils.SubjectMixin):
 
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Starting full sync.'))
         # 1. go through local notes, if anything changed or new, update to server
-        for ni, lk in enumerate(self.notes.keys()):
-            n = self.notes[lk]
-            if not n.get('key') or float(n.get('modifydate')) > float(n.get('syncdate')):
-                uret = self.simplenote.update_note(n)
+        # deleted notes are in the tombstones until the server has them.
+        # the server keys of new notes go into the outbox in one write.
+        new_keys = {}
+        for ni, lk in enumerate(self.notes.keys() + self.tombstones.keys()):
+            n = self.helper_get_note(lk)
+            if not n.key or n.modifydate > (n.syncdate or 0):
+                self.helper_fault_content(lk)
+                uret = self.simplenote.update_note(n.to_dict())
                 if uret[1] == 0:
+                    if n.deleted:
+                        # the server has the deletion, whatever it sent back.
+                        self.helper_purge(lk)
+                        continue
+
                     # replace n with uret[0]
                     # if this was a new note, our local key is not valid anymore
                     del self.notes[lk]
+                    self.dirty_save.discard(lk)
+                    self.dirty_sync.discard(lk)
                     # in either case (new or existing note), save note at assigned key
                     k = uret[0].get('key')
                     # we merge the note we got back (content coud be empty!)
-                    n.update(uret[0])
+                    self.helper_update_note(k, n, uret[0])
+                    if lk != k:
+                        self.helper_index_remove(lk)
+                        self.helper_index_changed(k)
+
                     # and put it at the new key slot
                     self.notes[k] = n
+                    if lk != k:
+                        # so does what we know about its content
+                        for m in (self.content_cache, self.content_used, self.cold_content):
+                            if lk in m:
+                                m[k] = m.pop(lk)
+
+                    self.helper_cache_content(k)
+                    if lk != k:
+                        new_keys[lk] = k
+
+                    if self.config.notes_as_txt and lk != k:
+                        # the text file stays the same
+                        with self.txt_lock:
+                            self.titles.rekey(lk, k)
+
+                    if self.history is not None and lk != k:
+                        self.history.rename(lk, k)
 
                     # record that we just synced
                     uret[0]['syncdate'] = now
 
-                    # whatever the case may be, k is now updated
+                    # whatever the case may be, k is now updated. until it is
+                    # saved below, the store does not have it, so it must not
+                    # be evicted.
                     local_updates[k] = True
+                    self.dirty_save.add(k)
                     if lk != k:
                         # if lk was a different (purely local) key, should be deleted
                         local_deletes[lk] = True
@@ -712,8 +2072,11 @@ class NotesDB(utils.SubjectMixin):
                     self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced modified note %d to server.' % (ni,)))
 
                 else:
+                    self.sync_outbox.set_keys(new_keys)
                     raise SyncError("Sync step 1 error - Could not update note to server")
 
+        self.sync_outbox.set_keys(new_keys)
+
         # 2. if remote syncnum > local syncnum, update our note; if key is new, add note to local.
         # this gets the FULL note list, even if multiple gets are required
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Retrieving full note list from server, could take a while.'))
@@ -731,17 +2094,28 @@ class NotesDB(utils.SubjectMixin):
         for ni, n in enumerate(nl):
             k = n.get('key')
             server_keys[k] = True
+            if int(n.get('deleted', 0)):
+                # deleted on the server, so we don't need it either. a local
+                # change would have undeleted it in phase 1.
+                if self.helper_get_note(k) is not None:
+                    self.helper_purge(k)
+                    local_updates.pop(k, None)
+
+                continue
+
             # this works, only because in phase 1 we rewrite local keys to
             # server keys when we get an updated not back from the server
             if k in self.notes:
                 # we already have this
                 # check if server n has a newer syncnum than mine
-                if int(n.get('syncnum')) > int(self.notes[k].get('syncnum', -1)):
+                if int(n.get('syncnum')) > self.notes[k].get('syncnum', -1):
                     # and the server is newer
                     ret = self.simplenote.get_note(k)
                     if ret[1] == 0:
-                        self.notes[k].update(ret[0])
+                        self.helper_update_note(k, self.notes[k], ret[0])
+                        self.helper_cache_content(k)
                         local_updates[k] = True
+                        self.dirty_save.add(k)
                         # in both cases, new or newer note, syncdate is now.
                         self.notes[k]['syncdate'] = now
                         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced newer note %d (%d) from server.' % (ni, lennl)))
@@ -751,11 +2125,16 @@ class NotesDB(utils.SubjectMixin):
                         sync_from_server_errors += 1
 
             else:
-                # new note
+                # new note, or one that was restored after we deleted it
                 ret = self.simplenote.get_note(k)
                 if ret[1] == 0:
-                    self.notes[k] = ret[0]
+                    self.tombstones.pop(k, None)
+                    self.notes[k] = Note.from_dict(ret[0])
+                    self.helper_add_tags(self.notes[k])
+                    self.helper_index_changed(k)
+                    self.helper_cache_content(k)
                     local_updates[k] = True
+                    self.dirty_save.add(k)
                     # in both cases, new or newer note, syncdate is now.
                     self.notes[k]['syncdate'] = now
                     self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced new note %d (%d) from server.' % (ni, lennl)))
@@ -765,14 +2144,21 @@ class NotesDB(utils.SubjectMixin):
                     sync_from_server_errors += 1
 
         # 3. for each local note not in server index, remove.
-        for lk in self.notes.keys():
+        for lk in self.notes.keys() + self.tombstones.keys():
             if lk not in server_keys:
-                if self.config.notes_as_txt:
-                    tfn = os.path.join(self.config.txt_path, utils.get_note_title_file(self.notes[lk]))
-                    if os.path.isfile(tfn):
-                        os.unlink(tfn)
-                del self.notes[lk]
-                local_deletes[lk] = True
+                k = self.helper_get_note(lk).key
+                if k and k != lk and k in self.notes:
+                    # a partial sync sent lk to the server, and phase 2
+                    # just added the server copy. it takes over the text
+                    # file and the history, before they are purged.
+                    if self.config.notes_as_txt:
+                        with self.txt_lock:
+                            self.titles.rekey(lk, k)
+
+                    if self.history is not None:
+                        self.history.rename(lk, k)
+
+                self.helper_purge(lk)
 
         # sync done, now write changes to db_path
         for uk in local_updates.keys():
@@ -782,78 +2168,129 @@ class NotesDB(utils.SubjectMixin):
             except WriteError, e:
                 raise WriteError(e)
 
+            self.dirty_save.discard(uk)
+
         for dk in local_deletes.keys():
-            fn = self.helper_key_to_fname(dk)
-            if os.path.exists(fn):
-                os.unlink(fn)
+            self.store.delete(dk)
+
+        self.store.sync()
 
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Full sync complete.'))
 
         return sync_from_server_errors
 
     def set_note_content(self, key, content):
+        self.helper_fault_content(key)
         n = self.notes[key]
         old_content = n.get('content')
         if content != old_content:
             n['content'] = content
             n['modifydate'] = time.time()
+            self.helper_cache_content(key)
+            self.helper_index_changed(key)
+            self.helper_note_changed(key)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def set_note_tags(self, key, tags):
+        self.helper_fault_content(key)
         n = self.notes[key]
-        old_tags = n.get('tags')
-        tags = utils.sanitise_tags(tags)
-        if tags != old_tags:
-            n['tags'] = tags
-            n['modifydate'] = time.time()
+        tags = tuple(utils.sanitise_tags(tags))
+        if tags != n.tags:
+            self.helper_remove_tags(n)
+            n.tags = tags
+            self.helper_add_tags(n)
+            self.helper_search_changed(key)
+            n.modifydate = time.time()
+            self.helper_note_changed(key)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def set_note_pinned(self, key, pinned):
+        self.helper_fault_content(key)
         n = self.notes[key]
-        old_pinned = utils.note_pinned(n)
-        if pinned != old_pinned:
-            if 'systemtags' not in n:
-                n['systemtags'] = []
-
-            systemtags = n['systemtags']
+        if bool(pinned) != n.pinned:
+            systemtags = n.systemtags or ()
 
+            # systemtags is a tuple, copies of this note shared with other
+            # threads keep the old one.
             if pinned:
                 # which by definition means that it was NOT pinned
-                systemtags.append('pinned')
+                n.systemtags = systemtags + ('pinned',)
 
             else:
-                systemtags.remove('pinned')
+                n.systemtags = tuple(st for st in systemtags if st != 'pinned')
 
-            n['modifydate'] = time.time()
+            n.modifydate = time.time()
+            self.helper_note_changed(key)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def worker_save(self):
         while True:
-            o = self.q_save.get()
+            # we write out everything that is waiting in one go, so that the
+            # store only has to make it durable once per batch.
+            batch = self.q_save.get_batch()
 
-            if o.action == ACTION_SAVE:
-                # this will write the savedate into o.note
-                # with filename o.key.json
-                try:
-                    self.helper_save_note(o.key, o.note)
+            try:
+                if self.sync_outbox is not None:
+                    # before the changes are on disc, they are in the outbox.
+                    self.sync_outbox.update(add=[o.key for o in batch if o.action == ACTION_SAVE and
+                                                 o.note.modifydate > (o.note.syncdate or 0)])
 
-                except WriteError, e:
-                    logging.error('FATAL ERROR in access to file system')
-                    print "FATAL ERROR: Check the nvpy.log"
-                    os._exit(1)
+                for o in batch:
+                    if o.action == ACTION_SAVE:
+                        # this will write the savedate into o.note
+                        # with filename o.key.json
+                        self.helper_save_note(o.key, o.note)
 
-                else:
+                    elif o.action == ACTION_PURGE:
+                        self.helper_purge_note(o.key)
+
+                self.store.sync()
+
+                if self.sync_outbox is not None:
+                    # the server has what we just wrote for these
+                    self.sync_outbox.update(
+                        remove=[o.key for o in batch if o.action == ACTION_PURGE or
+                                o.note.modifydate <= (o.note.syncdate or 0)],
+                        forget=[o.key for o in batch if o.action == ACTION_PURGE or o.note.key])
+
+            except WriteError, e:
+                logging.error('FATAL ERROR in access to file system')
+                print "FATAL ERROR: Check the nvpy.log"
+                os._exit(1)
+
+            else:
+                for o in batch:
                     # put the whole thing back into the result q
                     # now we don't have to copy, because this thread
                     # is never going to use o again.
                     # somebody has to read out the queue...
                     self.q_save_res.put(o)
 
+            self.q_save.task_done()
+
+    def worker_search(self):
+        while True:
+            s = self.q_search.get()
+            try:
+                # only the latest search is of any use
+                while True:
+                    s = self.q_search.get_nowait()
+
+            except Empty:
+                pass
+
+            r = self.helper_search(s)
+            if r is not None:
+                self.q_search_res.put((s, r))
+
     def worker_sync(self):
         while True:
             o = self.q_sync.get()
 
             if o.action == ACTION_SYNC_PARTIAL_TO_SERVER:
+                # from here on, o.note is what we send to and get back from
+                # the server.
+                o.note = o.note.to_dict()
                 self.waiting_for_simplenote = True
                 if 'key' in o.note:
                     logging.debug('Updating note %s (local key %s) to server.' % (o.note['key'], o.key))
@@ -875,6 +2312,11 @@ class NotesDB(utils.SubjectMixin):
 
                     logging.debug('Server replies with updated note ' + n['key'])
 
+                    if 'key' not in o.note:
+                        # the server has created the note, we must not send
+                        # it as a new note again, not even after a crash.
+                        self.sync_outbox.set_key(o.key, n['key'])
+
                     # syncdate was set when the note was copied into our queue
                     # we rely on that to determine when a returned note should
                     # overwrite a note in the main list.
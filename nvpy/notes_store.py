@@ -0,0 +1,1062 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Storage backends for NotesDB.
+
+A store only knows how to persist note dictionaries under their local key.
+Everything else (text mirroring, syncing, bookkeeping of save and sync
+dates) remains the responsibility of NotesDB.
+
+Every store offers the same small interface:
+
+* keys(): list of all stored local keys.
+* load_all(): iterate over (local key, note, mtime) for all stored notes.
+* load_content(key): read only the content of a single note.
+* save(key, note) and delete(key).
+* save_meta(key, note): like save(), for a note of which only the metadata
+  changed since it was last saved.
+* sync(): make everything saved so far durable. The save worker calls this
+  once per batch of saves.
+* close().
+
+mtime is the time at which the store last wrote the note. NotesDB compares it
+with the text mirror when notes_as_txt is active.
+"""
+
+import cPickle
+import hashlib
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+try:
+    # much faster directory scanning, especially on Windows
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+class ReadError(RuntimeError):
+    pass
+
+
+class WriteError(RuntimeError):
+    pass
+
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst if it exists.
+    """
+
+    try:
+        os.rename(src, dst)
+
+    except OSError:
+        # windows refuses to rename over an existing file
+        os.unlink(dst)
+        os.rename(src, dst)
+
+
+class JSONStore(object):
+    """One .json file per note in db_path.
+
+    This is the original nvPY storage format. Notes are written as compact
+    JSON, or zlib-compressed JSON once the encoded note reaches
+    compress_threshold bytes. Reading detects the format of each file, so
+    pretty-printed files from older versions and files written with another
+    threshold keep working. convert() rewrites all files in the current
+    format.
+
+    With a shard_depth above 0, note files are spread over that many levels
+    of subdirectories named after the first characters of their key, so
+    that no single directory has to hold a very large number of entries.
+    db_path/notes.layout records the depth the files are laid out with, and
+    relayout() moves them when the configured depth changes.
+
+    With snapshot enabled, the store also maintains db_path/notes.snapshot,
+    a single pickle of all notes that were in sync with the disc when it was
+    written, each with the mtime and size of its file at that moment.
+    load_all() uses a snapshot entry whenever the file still has the same
+    mtime and size, so only files that changed since are parsed again.
+
+    With load_workers above 1, note files that have to be parsed are read
+    by a pool of that many threads. The threads only overlap their waiting
+    for the disc, they decode the JSON one at a time. That pays off on a
+    slow or cold disc, when the files are cached a serial load is faster.
+
+    @ivar stats: {local key: (mtime, size)} of each note file as we last saw
+    or wrote it. Written by whichever thread loads or saves.
+    """
+
+    SNAPSHOT_FILENAME = 'notes.snapshot'
+    SNAPSHOT_VERSION = 1
+
+    # first byte of a zlib stream at any compression level. JSON notes
+    # always start with '{' or whitespace.
+    ZLIB_MAGIC = '\x78'
+
+    LAYOUT_FILENAME = 'notes.layout'
+    # characters of the key used per level of subdirectories
+    SHARD_WIDTH = 2
+
+    def __init__(self, db_path, snapshot=False, load_workers=0, compress_threshold=0,
+                 shard_depth=0):
+        self.db_path = db_path
+        self.snapshot = snapshot
+        self.load_workers = load_workers
+        self.compress_threshold = compress_threshold
+        self.shard_depth = shard_depth
+        self.snapshot_fname = os.path.join(db_path, self.SNAPSHOT_FILENAME)
+        self.stats = {}
+
+    def key_to_fname(self, k):
+        w = self.SHARD_WIDTH
+        parts = [k[i * w:(i + 1) * w].ljust(w, '_') for i in range(self.shard_depth)]
+        return os.path.join(self.db_path, *(parts + [k + '.json']))
+
+    def fname_to_key(self, fn):
+        return os.path.splitext(os.path.basename(fn))[0]
+
+    def scan(self, any_depth=False):
+        """Stat all note files in one pass over db_path.
+
+        @param any_depth: also find note files that are not at shard_depth.
+        @returns: {local key: (filename, mtime, size)}
+        """
+
+        files = {}
+        self._scan_dir(self.db_path, None if any_depth else self.shard_depth, files)
+        return files
+
+    def _scan_dir(self, path, depth, files):
+        if scandir is not None:
+            for de in scandir(path):
+                if depth != 0 and len(de.name) == self.SHARD_WIDTH and de.is_dir():
+                    self._scan_dir(de.path, depth and depth - 1, files)
+
+                elif depth in (0, None) and de.name.endswith('.json') and de.is_file():
+                    st = de.stat()
+                    files[self.fname_to_key(de.name)] = (de.path, st.st_mtime, st.st_size)
+
+        else:
+            for name in os.listdir(path):
+                fn = os.path.join(path, name)
+                if depth != 0 and len(name) == self.SHARD_WIDTH and os.path.isdir(fn):
+                    self._scan_dir(fn, depth and depth - 1, files)
+
+                elif depth in (0, None) and name.endswith('.json'):
+                    st = os.stat(fn)
+                    files[self.fname_to_key(name)] = (fn, st.st_mtime, st.st_size)
+
+    @classmethod
+    def read_layout(cls, db_path):
+        """Return the shard depth the note files in db_path are laid out with.
+
+        Without a layout file, they are all directly in db_path.
+        """
+
+        fname = os.path.join(db_path, cls.LAYOUT_FILENAME)
+        try:
+            with open(fname, 'rb') as f:
+                return int(f.read().strip())
+
+        except IOError:
+            return 0
+
+        except ValueError, e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (fname, str(e)))
+            raise ReadError('Error reading layout file')
+
+    def relayout(self):
+        """Move all note files into the layout of shard_depth.
+
+        Files are searched for at any depth, so that running this again after
+        an interruption picks up where it stopped. The snapshot stays valid,
+        renaming does not change mtime or size.
+
+        @returns: number of files that were moved.
+        """
+
+        if self.read_layout(self.db_path) == self.shard_depth:
+            return 0
+
+        moved = 0
+        old_dirs = set()
+        try:
+            for k, (fn, mtime, size) in self.scan(any_depth=True).iteritems():
+                nfn = self.key_to_fname(k)
+                if fn != nfn:
+                    self._make_dirs(nfn)
+                    os.rename(fn, nfn)
+                    old_dirs.add(os.path.dirname(fn))
+                    moved += 1
+
+            tfn = os.path.join(self.db_path, self.LAYOUT_FILENAME) + '.tmp'
+            with open(tfn, 'wb') as f:
+                f.write('%d\n' % (self.shard_depth,))
+
+            replace_file(tfn, os.path.join(self.db_path, self.LAYOUT_FILENAME))
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_init: Error moving note files in %s: %s' % (self.db_path, str(e)))
+            raise WriteError('Error moving note files')
+
+        # remove the subdirectories that were emptied, deepest first
+        for d in sorted(old_dirs, key=len, reverse=True):
+            self._remove_empty_dirs(d)
+
+        logging.debug('Moved %d note files to shard depth %d.' % (moved, self.shard_depth))
+        return moved
+
+    def _make_dirs(self, fn):
+        if self.shard_depth:
+            d = os.path.dirname(fn)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def _remove_empty_dirs(self, d):
+        # remove d and its parents up to db_path, for as long as they are empty
+        while d != self.db_path:
+            try:
+                os.rmdir(d)
+
+            except OSError:
+                break
+
+            d = os.path.dirname(d)
+
+    def keys(self):
+        return self.scan().keys()
+
+    def encode_note(self, note):
+        data = json.dumps(note, separators=(',', ':'))
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            data = zlib.compress(data)
+
+        return data
+
+    def decode_note(self, data):
+        if data[:1] == self.ZLIB_MAGIC:
+            data = zlib.decompress(data)
+
+        return json.loads(data)
+
+    def _parse_file(self, fn):
+        """Return (note, None), or (None, exception) if fn could not be read.
+
+        This runs in the load worker threads, so errors are handed back
+        instead of raised.
+        """
+
+        try:
+            with open(fn, 'rb') as f:
+                return self.decode_note(f.read()), None
+
+        except (IOError, ValueError, zlib.error), e:
+            return None, e
+
+    def _check_parsed(self, fn, n, e):
+        if isinstance(e, IOError):
+            logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
+            raise ReadError('Error opening note file')
+
+        elif e is not None:
+            logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
+            raise ReadError('Error reading note file')
+
+        return n
+
+    def load_file(self, fn):
+        return self._check_parsed(fn, *self._parse_file(fn))
+
+    def load_files(self, fnlist):
+        """Parse all files in fnlist, with a pool of threads if so configured.
+
+        @returns: list of notes, in the same order as fnlist.
+        @raise ReadError: for the first file in fnlist that could not be
+        read, no matter which worker got to it first.
+        """
+
+        if self.load_workers > 1 and len(fnlist) > 1:
+            pool = ThreadPool(min(self.load_workers, len(fnlist)))
+            try:
+                results = pool.map(self._parse_file, fnlist, chunksize=32)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            results = [self._parse_file(fn) for fn in fnlist]
+
+        return [self._check_parsed(fn, n, e) for fn, (n, e) in zip(fnlist, results)]
+
+    def load_content(self, k):
+        return self.load_file(self.key_to_fname(k)).get('content')
+
+    def read_snapshot(self):
+        """Return {local key: (mtime, size, note)} from the snapshot file.
+
+        A missing, outdated or unreadable snapshot is not an error, we
+        simply parse all the files again.
+        """
+
+        try:
+            with open(self.snapshot_fname, 'rb') as f:
+                snap = cPickle.load(f)
+
+        except IOError:
+            return {}
+
+        except Exception, e:
+            logging.error('NotesDB_init: Ignoring snapshot %s: %s' % (self.snapshot_fname, str(e)))
+            return {}
+
+        if not isinstance(snap, dict) or snap.get('version') != self.SNAPSHOT_VERSION:
+            return {}
+
+        return snap['notes']
+
+    def write_snapshot(self, notes, stats):
+        """Write notes to the snapshot file.
+
+        This can run in any thread, as long as notes and stats were copied
+        together on the main thread, see NotesDB.helper_write_snapshot().
+
+        @param notes: {local key: note} of notes that are in sync with the disc.
+        @param stats: copy of self.stats taken at the same time.
+        """
+
+        entries = {}
+        for k, n in notes.iteritems():
+            st = stats.get(k)
+            if st is not None:
+                entries[k] = (st[0], st[1], n)
+
+        # the exit snapshot could overlap with a background one
+        tfn = '%s.%d.tmp' % (self.snapshot_fname, threading.current_thread().ident)
+        try:
+            with open(tfn, 'wb') as f:
+                cPickle.dump({'version': self.SNAPSHOT_VERSION, 'notes': entries}, f, cPickle.HIGHEST_PROTOCOL)
+
+            replace_file(tfn, self.snapshot_fname)
+
+        except (IOError, OSError), e:
+            # the snapshot is only an optimisation, so this is not fatal.
+            logging.error('NotesDB_snapshot: Error writing %s: %s' % (self.snapshot_fname, str(e)))
+
+        else:
+            logging.debug('Wrote snapshot of %d notes.' % (len(entries),))
+
+    def load_all(self):
+        snap = self.read_snapshot() if self.snapshot else {}
+        files = self.scan()
+
+        notes = {}
+        for k, (fn, mtime, size) in files.iteritems():
+            entry = snap.get(k)
+            if entry is not None and entry[0] == mtime and entry[1] == size:
+                notes[k] = entry[2]
+
+        # whatever the snapshot could not give us is parsed, in key order so
+        # that results and errors do not depend on the directory order.
+        todo = sorted(k for k in files if k not in notes)
+        for k, n in zip(todo, self.load_files([files[k][0] for k in todo])):
+            notes[k] = n
+
+        if snap:
+            logging.debug('Snapshot used, parsed %d changed note files.' % (len(todo),))
+
+        for k in sorted(files):
+            fn, mtime, size = files[k]
+            self.stats[k] = (mtime, size)
+            yield k, notes[k], mtime
+
+    def save(self, k, note):
+        fn = self.key_to_fname(k)
+        # write to a temporary file first, so that a crash halfway through
+        # can never leave us with a truncated note.
+        tfn = fn + '.tmp'
+        try:
+            self._make_dirs(fn)
+            with open(tfn, 'wb') as f:
+                f.write(self.encode_note(note))
+
+            replace_file(tfn, fn)
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
+            raise WriteError('Error opening note file')
+
+        st = os.stat(fn)
+        self.stats[k] = (st.st_mtime, st.st_size)
+
+    def save_meta(self, k, note):
+        # the content lives in the same file, so it has to be rewritten.
+        self.save(k, note)
+
+    def delete(self, k):
+        fn = self.key_to_fname(k)
+        if os.path.isfile(fn):
+            os.unlink(fn)
+            if self.shard_depth:
+                self._remove_empty_dirs(os.path.dirname(fn))
+
+        self.stats.pop(k, None)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def convert(self):
+        """Rewrite all note files in the current format.
+
+        File modification times are kept, so that the text mirror of
+        notes_as_txt does not look newer than the notes afterwards. nvPY must
+        not be running on db_path at the same time.
+
+        @returns: (number of notes, total size before, total size after)
+        """
+
+        files = self.scan()
+        fnlist = [files[k][0] for k in sorted(files)]
+        before = after = 0
+        for fn, n in zip(fnlist, self.load_files(fnlist)):
+            st = os.stat(fn)
+            k = self.fname_to_key(fn)
+            self.save(k, n)
+            os.utime(fn, (st.st_atime, st.st_mtime))
+            before += st.st_size
+            after += self.stats[k][1]
+
+        return len(fnlist), before, after
+
+
+class SQLiteStore(object):
+    """All notes in a single SQLite database, one row per note.
+
+    The Simplenote metadata lives in separate columns, the note content is
+    stored as a UTF-8 blob and whatever other fields a note might have end up
+    JSON-encoded in the extra column. Saves are upserts. Saves, metadata
+    updates and deletions all go into one transaction, which sync()
+    commits, so a batch of the save worker costs a single commit.
+
+    The connection is shared between the main thread (startup and full sync)
+    and the save worker, hence the lock.
+    """
+
+    DB_FILENAME = 'notes.sqlite'
+
+    # a single SELECT is already as fast as a snapshot would be.
+    snapshot = False
+
+    # columns holding plain scalar note fields, in table order.
+    META_COLUMNS = ['key', 'modifydate', 'createdate', 'syncdate', 'savedate',
+                    'syncnum', 'version', 'deleted']
+
+    # columns holding list note fields, stored as JSON text.
+    LIST_COLUMNS = ['tags', 'systemtags']
+
+    def __init__(self, db_path, load_workers=0):
+        self.db_path = db_path
+        # only used for the migration of json notes
+        self.load_workers = load_workers
+        self.fname = os.path.join(db_path, self.DB_FILENAME)
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(self.fname, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS notes ('
+                'localkey TEXT PRIMARY KEY, key TEXT, '
+                'modifydate REAL, createdate REAL, syncdate REAL, savedate REAL, '
+                'syncnum INTEGER, version INTEGER, deleted INTEGER, '
+                'tags TEXT, systemtags TEXT, extra TEXT, content BLOB)')
+
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    def keys(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute('SELECT localkey FROM notes')]
+
+    def _row_to_note(self, row):
+        # row is localkey, META_COLUMNS, LIST_COLUMNS, extra, content
+        note = {}
+        if row[-2]:
+            note.update(json.loads(row[-2]))
+
+        for i, c in enumerate(self.META_COLUMNS):
+            v = row[1 + i]
+            if v is not None:
+                note[c] = v
+
+        offset = 1 + len(self.META_COLUMNS)
+        for i, c in enumerate(self.LIST_COLUMNS):
+            v = row[offset + i]
+            if v is not None:
+                note[c] = json.loads(v)
+
+        if row[-1] is not None:
+            note['content'] = str(row[-1]).decode('utf-8')
+
+        return note
+
+    def _note_to_row(self, k, note):
+        known = set(self.META_COLUMNS + self.LIST_COLUMNS + ['content'])
+        extra = dict((f, v) for f, v in note.items() if f not in known)
+
+        row = [k]
+        row += [note.get(c) for c in self.META_COLUMNS]
+        row += [json.dumps(note[c]) if c in note else None for c in self.LIST_COLUMNS]
+        row.append(json.dumps(extra) if extra else None)
+
+        c = note.get('content')
+        if c is not None:
+            if isinstance(c, unicode):
+                c = c.encode('utf-8')
+
+            c = buffer(c)
+
+        row.append(c)
+        return row
+
+    def load_all(self):
+        cols = ', '.join(['localkey'] + self.META_COLUMNS + self.LIST_COLUMNS + ['extra', 'content'])
+        with self.lock:
+            try:
+                rows = self.conn.execute('SELECT %s FROM notes' % (cols,)).fetchall()
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_init: Error reading %s: %s' % (self.fname, str(e)))
+                raise ReadError('Error reading note database')
+
+        for row in rows:
+            try:
+                n = self._row_to_note(row)
+
+            except ValueError, e:
+                logging.error('NotesDB_init: Error reading note %s: %s' % (row[0], str(e)))
+                raise ReadError('Error reading note database')
+
+            # savedate is when we last wrote the row, just like a file mtime.
+            yield row[0], n, n.get('savedate', 0)
+
+    def load_content(self, k):
+        with self.lock:
+            try:
+                r = self.conn.execute('SELECT content FROM notes WHERE localkey = ?', (k,)).fetchone()
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_load: Error reading %s: %s' % (k, str(e)))
+                raise ReadError('Error reading note database')
+
+        if r is None or r[0] is None:
+            return None
+
+        return str(r[0]).decode('utf-8')
+
+    def _upsert(self, rows):
+        cols = ['localkey'] + self.META_COLUMNS + self.LIST_COLUMNS + ['extra', 'content']
+        sql = 'INSERT OR REPLACE INTO notes (%s) VALUES (%s)' % \
+              (', '.join(cols), ', '.join(['?'] * len(cols)))
+
+        with self.lock:
+            try:
+                self.conn.executemany(sql, rows)
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note database')
+
+    def save(self, k, note):
+        # we record the time of writing in the row, NotesDB only updates the
+        # in-memory savedate afterwards.
+        note = dict(note)
+        note['savedate'] = time.time()
+        self._upsert([self._note_to_row(k, note)])
+
+    def save_meta(self, k, note):
+        # update everything but the content blob, which is still current.
+        note = dict(note)
+        note['savedate'] = time.time()
+        row = self._note_to_row(k, note)
+
+        cols = self.META_COLUMNS + self.LIST_COLUMNS + ['extra']
+        sql = 'UPDATE notes SET %s WHERE localkey = ?' % \
+              ', '.join(['%s = ?' % c for c in cols])
+
+        with self.lock:
+            try:
+                updated = self.conn.execute(sql, row[1:-1] + [k]).rowcount
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note database')
+
+        if not updated:
+            # not in the database yet after all
+            self._upsert([row])
+
+    def delete(self, k):
+        with self.lock:
+            try:
+                self.conn.execute('DELETE FROM notes WHERE localkey = ?', (k,))
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_save: Error deleting %s: %s' % (k, str(e)))
+                raise WriteError('Error writing note database')
+
+    def sync(self):
+        with self.lock:
+            try:
+                self.conn.commit()
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note database')
+
+    def get_meta(self, name):
+        with self.lock:
+            r = self.conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+
+        return r[0] if r else None
+
+    def set_meta(self, name, value):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+    def migrate_from_json(self):
+        """One-time import of an existing JSON db_path.
+
+        All notes are inserted in one transaction, after which the .json
+        files are moved to db_path/json_migrated, so that they do not come
+        back to life when switching back to the json backend.
+        """
+
+        if self.get_meta('json_migrated'):
+            return 0
+
+        js = JSONStore(self.db_path, load_workers=self.load_workers,
+                       shard_depth=JSONStore.read_layout(self.db_path))
+        files = js.scan()
+        fnlist = [files[k][0] for k in sorted(files)]
+        rows = []
+        for fn, n in zip(fnlist, js.load_files(fnlist)):
+            n['savedate'] = os.path.getmtime(fn)
+            rows.append(self._note_to_row(js.fname_to_key(fn), n))
+
+        if rows:
+            self._upsert(rows)
+            self.sync()
+            backup_path = os.path.join(self.db_path, 'json_migrated')
+            if not os.path.exists(backup_path):
+                os.mkdir(backup_path)
+
+            for fn in fnlist:
+                os.rename(fn, os.path.join(backup_path, os.path.basename(fn)))
+
+            logging.debug('Migrated %d json notes to %s' % (len(rows), self.fname))
+
+        self.set_meta('json_migrated', '1')
+        return len(rows)
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.conn.close()
+
+
+class JournalStore(object):
+    """Write-ahead journal in front of another store.
+
+    Saves are appended as compact change records to db_path/notes.journal:
+    one JSON object per line with the local key, the time of the save and
+    only the fields that changed since the previous save of that note (the
+    first save of a note in a session records all fields). sync() does the
+    fsync, so the save worker only pays for it once per batch.
+
+    A background thread regularly folds the journal into the wrapped store:
+    the journal is rotated to notes.journal.old, the latest state of every
+    note in it is written to the store, and notes.journal.old is removed.
+    Notes that are in the store are only remembered by a digest of their
+    fields, so that the journal does not keep a copy of every note saved.
+    At startup, load_all() replays notes.journal.old and notes.journal on
+    top of whatever the store returns. Records contain field values and not
+    differences, so replaying after a partial compaction does no harm.
+    """
+
+    JOURNAL_FILENAME = 'notes.journal'
+
+    # compact at the latest after this many seconds ...
+    COMPACT_INTERVAL = 30
+    # ... or as soon as the journal grows beyond this many bytes.
+    COMPACT_SIZE = 1024 * 1024
+
+    def __init__(self, store, db_path):
+        self.store = store
+        self.fname = os.path.join(db_path, self.JOURNAL_FILENAME)
+        self.old_fname = self.fname + '.old'
+
+        # protects the journal file, self.base, self.digests and self.pending
+        self.lock = threading.Lock()
+        # local key: complete note that still has to go to the store
+        self.base = {}
+        # local key: {field: _digest(value)} of a note the store has, to
+        # diff against
+        self.digests = {}
+        # local key: True if the note has to be written to the store, False
+        # if it has to be deleted from the store.
+        self.pending = {}
+
+        self.f = open(self.fname, 'ab')
+        self.compact_event = threading.Event()
+
+        thread_compact = threading.Thread(target=self.worker_compact)
+        thread_compact.setDaemon(True)
+        thread_compact.start()
+
+    @property
+    def snapshot(self):
+        return self.store.snapshot
+
+    @property
+    def stats(self):
+        return self.store.stats
+
+    def write_snapshot(self, notes, stats):
+        self.store.write_snapshot(notes, stats)
+
+    def read_journal(self):
+        """Return list of all records in the rotated and current journal.
+        """
+
+        records = []
+        for fn in [self.old_fname, self.fname]:
+            if not os.path.exists(fn):
+                continue
+
+            with open(fn, 'rb') as f:
+                for i, line in enumerate(f):
+                    try:
+                        records.append(json.loads(line))
+
+                    except ValueError:
+                        # a crash in the middle of an append leaves a torn
+                        # last line, the note is still in the store.
+                        logging.error('NotesDB_init: Ignoring broken journal record %d in %s' % (i, fn))
+
+        return records
+
+    def keys(self):
+        keys = dict.fromkeys(self.store.keys(), True)
+        for r in self.read_journal():
+            keys[r['k']] = not r.get('d')
+
+        return [k for k, v in keys.items() if v]
+
+    def load_all(self):
+        # replay: later records win, a delete record drops the note.
+        replayed = {}
+        for r in self.read_journal():
+            if r.get('d'):
+                replayed[r['k']] = None
+
+            else:
+                rn = replayed.get(r['k'])
+                if rn is None:
+                    rn = replayed[r['k']] = {'fields': {}, 't': 0}
+
+                rn['fields'].update(r['n'])
+                rn['t'] = r['t']
+
+        for k, n, mtime in self.store.load_all():
+            if k in replayed:
+                rn = replayed.pop(k)
+                if rn is None:
+                    self.pending[k] = False
+                    continue
+
+                n.update(rn['fields'])
+                mtime = max(mtime, rn['t'])
+                self.base[k] = n.copy()
+                self.pending[k] = True
+
+            yield k, n, mtime
+
+        # notes that were created after the last compaction
+        for k, rn in replayed.items():
+            if rn is None:
+                continue
+
+            n = rn['fields']
+            self.base[k] = n.copy()
+            self.pending[k] = True
+            yield k, n, rn['t']
+
+        if self.pending:
+            logging.debug('Replayed journal for %d notes.' % (len(self.pending),))
+            self.compact_event.set()
+
+    def load_content(self, k):
+        with self.lock:
+            n = self.base.get(k)
+
+        if n is not None and 'content' in n:
+            return n['content']
+
+        return self.store.load_content(k)
+
+    def _append(self, record):
+        # with self.lock held
+        self.f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        if self.f.tell() > self.COMPACT_SIZE:
+            self.compact_event.set()
+
+    def save(self, k, note):
+        note = note.copy()
+        # savedate is only bookkeeping, it changes with every save.
+        note.pop('savedate', None)
+
+        with self.lock:
+            old = self.base.get(k)
+            digest = self.digests.get(k)
+            if old is not None:
+                fields = dict((f, v) for f, v in note.items() if old.get(f) != v)
+
+            elif digest is not None:
+                fields = dict((f, v) for f, v in note.items() if digest.get(f) != _digest(v))
+                if fields and 'content' in digest and 'content' not in note:
+                    # the compacted note is written again, with its content
+                    try:
+                        old = {'content': self.store.load_content(k)}
+
+                    except ReadError:
+                        raise WriteError('Error reading note for the journal')
+
+            else:
+                fields = note
+
+            if not fields and (old is not None or digest is not None):
+                # nothing changed since the last time
+                return
+
+            # fields that disappeared, for example the content of a note that
+            # the server sent back unchanged, are simply kept.
+            record = {'k': k, 't': time.time(), 'n': fields}
+            try:
+                self._append(record)
+
+            except IOError, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note journal')
+
+            if old is not None:
+                old = old.copy()
+                old.update(note)
+                note = old
+
+            self.base[k] = note
+            self.digests.pop(k, None)
+            self.pending[k] = True
+
+    def save_meta(self, k, note):
+        # save() only journals the fields that changed anyway.
+        self.save(k, note)
+
+    def delete(self, k):
+        with self.lock:
+            try:
+                self._append({'k': k, 't': time.time(), 'd': 1})
+
+            except IOError, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note journal')
+
+            self.base.pop(k, None)
+            self.digests.pop(k, None)
+            self.pending[k] = False
+
+    def sync(self):
+        with self.lock:
+            try:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_save: Error syncing %s: %s' % (self.fname, str(e)))
+                raise WriteError('Error writing note journal')
+
+    def _rotate(self):
+        # with self.lock held: move the current journal out of the way and
+        # start a new, empty one.
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+        if os.path.exists(self.old_fname):
+            # a previous compaction did not finish, keep its records too.
+            with open(self.old_fname, 'ab') as fo:
+                with open(self.fname, 'rb') as fi:
+                    fo.write(fi.read())
+
+                fo.flush()
+                os.fsync(fo.fileno())
+
+            os.unlink(self.fname)
+
+        else:
+            os.rename(self.fname, self.old_fname)
+
+        self.f = open(self.fname, 'ab')
+
+    def compact(self):
+        """Fold all pending journal records into the wrapped store.
+        """
+
+        with self.lock:
+            if not self.pending or self.f.closed:
+                return
+
+            pending, self.pending = self.pending, {}
+            # base entries are replaced and never changed, so we can use
+            # them outside of the lock.
+            states = [(k, self.base.get(k) if keep else None) for k, keep in pending.items()]
+            try:
+                self._rotate()
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_compact: Error rotating %s: %s' % (self.fname, str(e)))
+                self.pending = pending
+                if self.f.closed:
+                    try:
+                        self.f = open(self.fname, 'ab')
+
+                    except IOError, e:
+                        logging.error('NotesDB_compact: Error opening %s: %s' % (self.fname, str(e)))
+
+                return
+
+        try:
+            for k, n in states:
+                if n is None:
+                    self.store.delete(k)
+
+                else:
+                    self.store.save(k, n)
+
+            self.store.sync()
+
+        except (WriteError, OSError), e:
+            logging.error('NotesDB_compact: Error compacting journal: %s' % (str(e),))
+            # records are still in the rotated journal, try again later.
+            with self.lock:
+                for k, keep in pending.items():
+                    self.pending.setdefault(k, keep)
+
+            return
+
+        with self.lock:
+            try:
+                os.unlink(self.old_fname)
+
+            except OSError, e:
+                # replayed once more at the next startup, which does no harm.
+                logging.error('NotesDB_compact: Error removing %s: %s' % (self.old_fname, str(e)))
+
+            # the store has these now, unless they were saved again since
+            for k, n in states:
+                if n is not None and self.base.get(k) is n:
+                    del self.base[k]
+                    self.digests[k] = dict((f, _digest(v)) for f, v in n.items())
+
+        logging.debug('Compacted journal, %d notes written to store.' % (len(states),))
+
+    def worker_compact(self):
+        while True:
+            self.compact_event.wait(self.COMPACT_INTERVAL)
+            self.compact_event.clear()
+            self.compact()
+
+    def close(self):
+        # whatever is still in the journal is replayed at the next startup.
+        self.sync()
+        with self.lock:
+            self.f.close()
+
+        self.store.close()
+
+
+def _digest(v):
+    """Return what JournalStore remembers of field value v.
+    """
+
+    if isinstance(v, basestring) and len(v) > 64:
+        if isinstance(v, unicode):
+            v = v.encode('utf-8')
+
+        # a tuple never equals a field value
+        return ('md5', hashlib.md5(v).digest())
+
+    return v
+
+
+def open_store(config):
+    """Return the store selected by config.db_backend for config.db_path.
+    """
+
+    if config.db_backend == 'sqlite':
+        store = SQLiteStore(config.db_path, load_workers=config.load_workers)
+        store.migrate_from_json()
+
+    else:
+        store = JSONStore(config.db_path, snapshot=config.startup_snapshot,
+                          load_workers=config.load_workers,
+                          compress_threshold=config.compress_threshold,
+                          shard_depth=config.shard_depth)
+        store.relayout()
+
+    if config.save_journal:
+        store = JournalStore(store, config.db_path)
+
+    return store
+
+
+def main():
+    """Bulk operations on a json db_path. nvPY must not be running.
+
+    usage: python notes_store.py convert db_path [compress_threshold]
+               rewrite all notes as compact or compressed JSON
+           python notes_store.py shard db_path depth
+               move all notes into depth levels of subdirectories
+    """
+
+    args = sys.argv[1:]
+    if len(args) in (2, 3) and args[0] == 'convert':
+        threshold = int(args[2]) if len(args) == 3 else 0
+        store = JSONStore(args[1], compress_threshold=threshold,
+                          shard_depth=JSONStore.read_layout(args[1]))
+        count, before, after = store.convert()
+        print 'Converted %d notes, %d bytes -> %d bytes.' % (count, before, after)
+
+    elif len(args) == 3 and args[0] == 'shard':
+        store = JSONStore(args[1], shard_depth=int(args[2]))
+        print 'Moved %d notes.' % (store.relayout(),)
+
+    else:
+        print main.__doc__
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -60,6 +60,9 @@ else:
 
 VERSION = "0.9.4"
 
+# how often the main loop looks for the result of a background search
+SEARCH_POLL_MS = 20
+
 
 class Config:
     """
@@ -79,8 +82,21 @@ class Config:
                     'appdir': app_dir,
                     'home': home,
                     'notes_as_txt': '0',
+                    'txt_watch': '1',
+                    'db_backend': 'json',
+                    'startup_snapshot': '1',
+                    'load_workers': '0',
+                    'compress_threshold': '0',
+                    'shard_depth': '0',
+                    'save_journal': '0',
+                    'lazy_content': '0',
+                    'content_cache_mb': '32',
+                    'cold_content_minutes': '0',
+                    'history_revisions': '0',
                     'housekeeping_interval': '2',
                     'search_mode': 'gstyle',
+                    'search_index': '0',
+                    'background_search': '1',
                     'case_sensitive': '1',
                     'search_tags': '1',
                     'sort_mode': '1',
@@ -129,10 +145,24 @@ class Config:
         self.simplenote_sync = cp.getint(cfg_sec, 'simplenote_sync')
         # make logic to find in $HOME if not set
         self.db_path = cp.get(cfg_sec, 'db_path')
+        # json = one file per note, sqlite = single database file
+        self.db_backend = cp.get(cfg_sec, 'db_backend')
+        self.startup_snapshot = cp.getint(cfg_sec, 'startup_snapshot')
+        self.load_workers = cp.getint(cfg_sec, 'load_workers')
+        self.compress_threshold = cp.getint(cfg_sec, 'compress_threshold')
+        self.shard_depth = cp.getint(cfg_sec, 'shard_depth')
+        self.save_journal = cp.getint(cfg_sec, 'save_journal')
+        self.lazy_content = cp.getint(cfg_sec, 'lazy_content')
+        self.content_cache_mb = cp.getint(cfg_sec, 'content_cache_mb')
+        self.cold_content_minutes = cp.getint(cfg_sec, 'cold_content_minutes')
+        self.history_revisions = cp.getint(cfg_sec, 'history_revisions')
         #  0 = alpha sort, 1 = last modified first
         self.notes_as_txt = cp.getint(cfg_sec, 'notes_as_txt')
         self.txt_path = os.path.join(home, cp.get(cfg_sec, 'txt_path'))
+        self.txt_watch = cp.getint(cfg_sec, 'txt_watch')
         self.search_mode = cp.get(cfg_sec, 'search_mode')
+        self.search_index = cp.getint(cfg_sec, 'search_index')
+        self.background_search = cp.getint(cfg_sec, 'background_search')
         self.case_sensitive = cp.getint(cfg_sec, 'case_sensitive')
         self.search_tags = cp.getint(cfg_sec, 'search_tags')
         self.sort_mode = cp.getint(cfg_sec, 'sort_mode')
@@ -255,6 +285,7 @@ class Controller:
 
         self.notes_db.add_observer('synced:note', self.observer_notes_db_synced_note)
         self.notes_db.add_observer('change:note-status', self.observer_notes_db_change_note_status)
+        self.notes_db.add_observer('deleted:note', self.observer_notes_db_deleted_note)
 
         if self.config.simplenote_sync:
             self.notes_db.add_observer('progress:sync_full', self.observer_notes_db_sync_full)
@@ -266,6 +297,7 @@ class Controller:
         self.view.add_observer('delete:note', self.observer_view_delete_note)
         self.view.add_observer('select:note', self.observer_view_select_note)
         self.view.add_observer('change:entry', self.observer_view_change_entry)
+        self.view.add_observer('finish:search', self.observer_view_finish_search)
         self.view.add_observer('change:text', self.observer_view_change_text)
         self.view.add_observer('change:tags', self.observer_view_change_tags)
         self.view.add_observer('change:pinned', self.observer_view_change_pinned)
@@ -295,10 +327,13 @@ class Controller:
         self.notes_list_model.set_list(nn)
         self.notes_list_model.match_regexp = match_regexp
         self.view.set_note_tally(len(nn), active_notes, len(self.notes_db.notes))
+        self.view.set_tags(self.notes_db.get_tags())
 
         # we'll use this to keep track of the currently selected note
         # we only use idx, because key could change from right under us.
         self.selected_note_idx = -1
+        # set while poll_search() waits for a background search
+        self.polling_search = False
         self.view.select_note(0)
 
     def get_selected_note_key(self):
@@ -339,13 +374,23 @@ class Controller:
         # we overwrite.
 
         if selected_note_o.key == evt.lkey:
-            if selected_note_o.note['content'] != evt.old_note['content']:
+            # get_note() makes sure that we have the full content
+            note = self.notes_db.get_note(evt.lkey)
+            if note['content'] != evt.old_note['content']:
                 self.view.mute_note_data_changes()
                 # in this case, we want to keep the user's undo buffer so that they
                 # can undo synced back changes if they would want to.
-                self.view.set_note_data(selected_note_o.note, reset_undo=False)
+                self.view.set_note_data(note, reset_undo=False)
                 self.view.unmute_note_data_changes()
 
+    def observer_notes_db_deleted_note(self, notes_db, evt_type, evt):
+        """This observer gets called when a sync tells us that a note has
+        been deleted elsewhere. It is gone from notes_db, so it has to go
+        from the list as well.
+        """
+
+        self.view.refresh_notes_list()
+
     def observer_view_click_notelink(self, view, evt_type, note_name):
         # find note_name in titles, try to jump to that note
         # if not in current list, change search string in case
@@ -480,6 +525,21 @@ class Controller:
         return ' '.join([i for i in [savet, synct, wfsnt] if i])
 
     def observer_view_keep_house(self, view, evt_type, evt):
+        # pick up changes that other programs made to the text notes
+        changed = self.notes_db.process_txt_changes()
+        if changed:
+            self.view.refresh_notes_list()
+            skey = self.get_selected_note_key()
+            if skey in changed:
+                self.view.mute_note_data_changes()
+                # like a note synced back from the server, the user can
+                # undo this.
+                self.view.set_note_data(self.notes_db.get_note(skey), reset_undo=False)
+                self.view.unmute_note_data_changes()
+
+        # keep the search index up to date with what changed
+        self.notes_db.update_search_index()
+
         # queue up all notes that need to be saved
         nsaved = self.notes_db.save_threaded()
         msg = self.helper_save_sync_msg()
@@ -506,7 +566,7 @@ class Controller:
             ret = self.notes_db.sync_note_unthreaded(key)
             if ret and ret[1] == True:
                 self.view.update_selected_note_data(
-                        self.notes_db.notes[key])
+                        self.notes_db.get_note(key))
                 self.view.set_status_text(
                 'Synced updated note from server.')
 
@@ -531,14 +591,46 @@ class Controller:
             self.view.refresh_notes_list()
 
     def observer_view_change_entry(self, view, evt_type, evt):
+        if evt.typed and self.config.background_search:
+            # the list changes when the search is done, see poll_search().
+            # other changes, like a new note, have to be listed right away.
+            self.notes_db.search_threaded(evt.value)
+            if not self.polling_search:
+                self.polling_search = True
+                self.view.call_later(SEARCH_POLL_MS, self.poll_search)
+
+        else:
+            # for each new evt.value coming in, get a new list from the notes_db
+            # and set it in the notes_list_model
+            self.helper_set_notes_list(*self.notes_db.filter_notes(evt.value))
+
+    def observer_view_finish_search(self, view, evt_type, evt):
+        # the user is about to act on the notes list, so a background search
+        # that has not finished yet is done right away.
+        if self.notes_db.search_running is not None:
+            self.helper_set_notes_list(*self.notes_db.filter_notes(self.view.get_search_entry_text()))
+
+    def poll_search(self):
+        """Show the result of the background search once it is done.
+        """
+
+        r = self.notes_db.get_search_result()
+        if r is not None:
+            self.helper_set_notes_list(r.notes, r.match_regexp, r.active_notes)
+
+        if self.notes_db.search_running is not None:
+            self.view.call_later(SEARCH_POLL_MS, self.poll_search)
+
+        else:
+            self.polling_search = False
+
+    def helper_set_notes_list(self, nn, match_regexp, active_notes):
         # store the currently selected note key
         k = self.get_selected_note_key()
-        # for each new evt.value coming in, get a new list from the notes_db
-        # and set it in the notes_list_model
-        nn, match_regexp, active_notes = self.notes_db.filter_notes(evt.value)
         self.notes_list_model.set_list(nn)
         self.notes_list_model.match_regexp = match_regexp
         self.view.set_note_tally(len(nn), active_notes, len(self.notes_db.notes))
+        self.view.set_tags(self.notes_db.get_tags())
 
         idx = self.notes_list_model.get_idx(k)
 
@@ -620,9 +712,11 @@ class Controller:
             really_want_to_exit = self.view.askyesno("Confirm exit", msg)
 
             if really_want_to_exit:
+                self.notes_db.close()
                 self.view.close()
 
         else:
+            self.notes_db.close()
             self.view.close()
 
     def observer_view_create_note(self, view, evt_type, evt):
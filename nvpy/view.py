@@ -730,7 +730,18 @@ class View(utils.SubjectMixin):
         self.statusbar.set_centre_status('Listing %d / %d active notes (%d total)' % (filtered_notes, active_notes, total_notes))
 
     def set_search_entry_text(self, text):
-        self.search_entry_var.set(text)
+        self.search_entry_typed = False
+        try:
+            self.search_entry_var.set(text)
+
+        finally:
+            self.search_entry_typed = True
+
+    def call_later(self, ms, func):
+        """Call func from the Tk main loop after ms milliseconds.
+        """
+
+        self.root.after(ms, func)
 
     def _bind_events(self):
         # make sure window close also goes through our handler
@@ -934,6 +945,8 @@ class View(utils.SubjectMixin):
 
         search_entry.make_style()
         self.search_entry_var = tk.StringVar()
+        # False while set_search_entry_text() changes the entry
+        self.search_entry_typed = True
         self.search_entry = TriggeredcompleteEntry(search_frame, self.config.case_sensitive, textvariable=self.search_entry_var, style="Search.entry")
         self.search_entry_var.trace('w', self.handler_search_entry)
 
@@ -1240,6 +1253,10 @@ class View(utils.SubjectMixin):
         # 1. if a note is selected, focus that
         # 2. if nothing is selected, create a new note with this title
 
+        # the list has to be the one for what was typed, not for the
+        # keystroke before, while a background search is still running.
+        self.notify_observers('finish:search', utils.KeyValueObject())
+
         if self.notes_list.selected_idx >= 0:
             self.text_note.focus()
             self.text_note.see(tk.INSERT)
@@ -1251,8 +1268,10 @@ class View(utils.SubjectMixin):
             self.text_note.focus()
 
     def handler_search_entry(self, *args):
+        # typed is False for changes made with set_search_entry_text()
         self.notify_observers('change:entry',
-                              utils.KeyValueObject(value=self.search_entry_var.get()))
+                              utils.KeyValueObject(value=self.search_entry_var.get(),
+                                                   typed=self.search_entry_typed))
 
     def handler_search_mode(self, *args):
         """
@@ -1381,10 +1400,10 @@ class View(utils.SubjectMixin):
         if self.get_text() != note.get('content'):
             return True
 
-        tags = note.get('tags', [])
+        tags = note.get('tags', ())
         # get list of string tags from ui
         ui_tags = utils.sanitise_tags(self.tags_entry_var.get())
-        if ui_tags != tags:
+        if tuple(ui_tags) != tuple(tags):
             return True
 
         if bool(self.pinned_checkbutton_var.get()) != bool(utils.note_pinned(note)):
@@ -1468,27 +1487,21 @@ class View(utils.SubjectMixin):
 
         # clear the notes list
         self.notes_list.clear()
-        taglist = []
 
         for o in notes:
-            tags = o.note.get('tags')
-            if tags:
-                taglist += tags
-
             self.notes_list.append(o.note, utils.KeyValueObject(tagfound=o.tagfound))
 
-        if self.taglist is None:
-            # first time we get called, so we need to initialise
+    def set_tags(self, taglist):
+        """Set the tags that the search entry completes.
+
+        @param taglist: NotesDB.get_tags(), a new list only when the tags
+        changed.
+        """
+
+        if taglist is not self.taglist:
             self.taglist = taglist
             self.search_entry.set_completion_list(self.taglist)
 
-        else:
-            # only set completion list if the new combined taglist is larger.
-            taglist = list(set(self.taglist + taglist))
-            if len(taglist) > len(self.taglist):
-                self.taglist = taglist
-                self.search_entry.set_completion_list(self.taglist)
-
     def show_error(self, title, msg):
         tkMessageBox.showerror(title, msg)
 